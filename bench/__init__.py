@@ -0,0 +1,4 @@
+"""
+Offline benchmark of the bots against a local fake Bot API server.
+Run from the project directory: python -m bench.run --help
+"""
@@ -0,0 +1,168 @@
+"""
+Local stand-in for the Telegram Bot API.
+Answers the methods used by the bots with plausible results, serves file downloads,
+hands queued updates out through getUpdates and lets the benchmark wait until
+a given number of messages has been sent to a chat.
+"""
+import asyncio
+import itertools
+import json
+import os
+import time
+from collections import defaultdict
+
+from aiohttp import web
+
+FILE_SIZE = 64 * 1024  # bytes of every downloadable file
+
+
+class FakeBotAPI:
+    """
+    Bot API served on /bot{token}/{method} and /file/bot{token}/{path}.
+    Sends are counted per (token, chat_id) so a benchmark can wait for the replies to an update.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = defaultdict(int)  # method -> count
+        self._updates = defaultdict(asyncio.Queue)  # token -> queued updates
+        self._update_id = itertools.count(1)
+        self._message_id = itertools.count(1)
+        self._sent = defaultdict(int)  # (token, chat_id) -> sent messages
+        self._waiters = defaultdict(list)  # (token, chat_id) -> [(count, future)]
+        self._file = os.urandom(FILE_SIZE)
+        self.app = web.Application()
+        self.app.router.add_post('/bot{token}/{method}', self._method)
+        self.app.router.add_get('/file/bot{token}/{path:.+}', self._download)
+        self._runner = None
+        self._closing = None
+        self.url = None
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0):
+        self._closing = asyncio.Event()
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://{host}:{port}'
+
+    async def stop(self):
+        self._closing.set()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def push_update(self, token: str, update: dict) -> int:
+        """Queue the update for getUpdates of the token and return its update_id"""
+        update['update_id'] = next(self._update_id)
+        self._updates[token].put_nowait(update)
+        return update['update_id']
+
+    def wait_sent(self, token: str, chat_id: int, count: int) -> asyncio.Future:
+        """Return future resolved when `count` more messages are sent to the chat with the token"""
+        key = (token, int(chat_id))
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[key].append((self._sent[key] + count, future))
+        return future
+
+    def _count_sent(self, token: str, chat_id, amount: int = 1):
+        key = (token, int(chat_id))
+        self._sent[key] += amount
+        waiters = self._waiters.get(key)
+        if not waiters:
+            return
+        pending = []
+        for count, future in waiters:
+            if self._sent[key] >= count:
+                if not future.done():
+                    future.set_result(time.perf_counter())
+            else:
+                pending.append((count, future))
+        self._waiters[key] = pending
+
+    def _message(self, token: str, chat_id, **content) -> dict:
+        return {
+            'message_id': next(self._message_id),
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+            'from': {'id': int(token.split(':')[0]), 'is_bot': True, 'first_name': 'bench'},
+            **content,
+        }
+
+    @staticmethod
+    def _file_object(file_id: str) -> dict:
+        return {'file_id': file_id, 'file_unique_id': file_id[-16:], 'file_size': FILE_SIZE}
+
+    async def _method(self, request: web.Request) -> web.Response:
+        token = request.match_info['token']
+        method = request.match_info['method']
+        self.calls[method] += 1
+        form = await request.post()
+        for value in form.values():
+            if isinstance(value, web.FileField):
+                value.file.read()
+
+        if method == 'getUpdates':
+            return self._ok(await self._get_updates(token, form))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == 'getFile':
+            file_ = self._file_object(form['file_id'])
+            file_['file_path'] = f"photos/{form['file_id']}.jpg"
+            return self._ok(file_)
+        if method == 'getMe':
+            return self._ok({'id': int(token.split(':')[0]), 'is_bot': True, 'first_name': 'bench',
+                             'username': 'bench_bot'})
+        if method == 'sendMediaGroup':
+            count = len(json.loads(form['media']))
+            self._count_sent(token, form['chat_id'], count)
+            return self._ok([self._message(token, form['chat_id'], photo=[self._photo()]) for _ in range(count)])
+        if method.startswith('send'):
+            self._count_sent(token, form['chat_id'])
+            content_type = method[len('send'):].lower()
+            if content_type == 'message':
+                return self._ok(self._message(token, form['chat_id'], text=form.get('text', '')))
+            if content_type == 'photo':
+                return self._ok(self._message(token, form['chat_id'], photo=[self._photo()]))
+            return self._ok(self._message(
+                token, form['chat_id'], **{content_type: self._file_object(f'bench-{next(self._message_id)}')}
+            ))
+        if method.startswith('edit'):
+            self._count_sent(token, form['chat_id'])
+            return self._ok(self._message(token, form['chat_id'], text=form.get('text', '')))
+        return self._ok(True)
+
+    def _photo(self) -> dict:
+        photo = self._file_object(f'bench-photo-{next(self._message_id):016d}')
+        photo.update(width=1280, height=720)
+        return photo
+
+    async def _get_updates(self, token: str, form) -> list:
+        queue = self._updates[token]
+        limit = int(form.get('limit') or 100)
+        timeout = float(form.get('timeout') or 0)
+        updates = []
+        if queue.empty() and timeout:
+            # long poll until an update comes, the timeout expires or the server stops
+            get = asyncio.ensure_future(queue.get())
+            closing = asyncio.ensure_future(self._closing.wait())
+            await asyncio.wait([get, closing], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            closing.cancel()
+            if not get.done():
+                get.cancel()
+                return []
+            updates.append(get.result())
+        while not queue.empty() and len(updates) < limit:
+            updates.append(queue.get_nowait())
+        return updates
+
+    async def _download(self, request: web.Request) -> web.Response:
+        self.calls['download'] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.Response(body=self._file, content_type='application/octet-stream')
+
+    @staticmethod
+    def _ok(result) -> web.Response:
+        return web.json_response({'ok': True, 'result': result})
@@ -0,0 +1,354 @@
+"""
+Benchmark of catalog browsing, the add-event FSM and the chat relay.
+Both bots run as in production (long polling by default) against bench.fake_api
+and a seeded SQLite catalog in a temporary directory. Every simulated user goes
+through the scenarios round after round, an operation lasts from the moment its
+update is queued until the fake API has received all the messages it causes.
+Outbound rate limits are lifted unless --real-limits is given, so the numbers
+show the cost of the bot itself.
+
+    python -m bench.run --catalog-size 10000 --users 20 --rounds 5 --output bench.json
+    python -m bench.run --baseline bench.json
+"""
+import argparse
+import asyncio
+import importlib
+import itertools
+import json
+import logging
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from bench.fake_api import FakeBotAPI, FILE_SIZE
+
+CLIENT_TOKEN = '1000001:bench-client'
+SERVICE_TOKEN = '1000002:bench-service'
+USER_BASE = 10000000  # chat ids of the simulated users
+OWNER_BASE = 20000000  # chat ids of the event owners
+SEED_BATCH = 5000
+RELAY_TEXTS = 5  # text messages per relay round
+
+_ids = itertools.count(1)
+
+
+def configure(api_url: str, db_url: str, real_limits: bool, workdir: str):
+    """
+    Point the bots to the fake API and the bench database and keep the media store
+    and the log in workdir, must run before main__ is imported
+    """
+    try:
+        import config
+    except ImportError:
+        config = importlib.import_module('config_example')
+        sys.modules['config'] = config
+    config.CLIENT_TOKEN = CLIENT_TOKEN
+    config.SERVICE_TOKEN = SERVICE_TOKEN
+    config.BOT_API_SERVER = api_url
+    config.DB_URL = db_url
+    config.FSM_STORAGE = 'memory'
+    config.MEDIA_STORE_DIR = os.path.join(workdir, 'media')
+    config.LOG_FILE = os.path.join(workdir, 'Log_bot.log')
+    config.CATALOG_RENDER_MODE = 'photo'
+    if not real_limits:
+        config.OUTBOUND_GLOBAL_RATE = 1e9
+        config.OUTBOUND_CHAT_RATE = 1e9
+        config.OUTBOUND_CHAT_BURST = 1e9
+        config.OUTBOUND_GROUP_RATE = 1e9
+        config.OUTBOUND_MAX_IN_FLIGHT = 256
+
+
+async def seed(db_session, size: int, owners: int):
+    """Fill the catalog with `size` events of `owners` owners, event_id of row i is i + 1"""
+    from sqlalchemy import insert
+    from db.models import EventTable
+
+    expires = datetime.utcnow() + timedelta(days=365)
+    async with db_session() as session:
+        for start in range(0, size, SEED_BATCH):
+            await session.execute(insert(EventTable), [
+                {
+                    'user_id': OWNER_BASE + i % owners,
+                    'event_name': f'Событие {i}',
+                    'event_header': f'Концерт номер {i} в клубе {i % 97}',
+                    'event_description': f'Описание события {i}: музыка, выставка, лекция {i % 13}',
+                    'event_media': f'seed-photo-{i:016d}',
+                    'event_end_show_date': expires,
+                }
+                for i in range(start, min(start + SEED_BATCH, size))
+            ])
+        await session.commit()
+
+
+def _user(chat_id: int) -> dict:
+    return {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'}
+
+
+def message_update(chat_id: int, **content) -> dict:
+    return {'message': {
+        'message_id': next(_ids),
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': _user(chat_id),
+        **content,
+    }}
+
+
+def callback_update(chat_id: int, data: str) -> dict:
+    return {'callback_query': {
+        'id': str(next(_ids)),
+        'from': _user(chat_id),
+        'chat_instance': str(chat_id),
+        'data': data,
+        'message': {
+            'message_id': next(_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': 'bench',
+        },
+    }}
+
+
+def photo() -> list:
+    n = next(_ids)
+    return [{'file_id': f'user-photo-{n}', 'file_unique_id': f'u{n:015d}', 'width': 1280, 'height': 720,
+             'file_size': FILE_SIZE}]
+
+
+def percentile(values: list, q: float) -> float:
+    """Return the nearest-rank percentile of sorted values"""
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+class Bench:
+    """
+    Feeds updates to the bots and records latency of the operations by scenario.
+    """
+
+    def __init__(self, api: FakeBotAPI, catalog_size: int, timeout: float):
+        self.api = api
+        self.catalog_size = catalog_size
+        self.timeout = timeout
+        self.latency = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.dispatchers = None  # bot token -> Dispatcher when the updates are fed directly
+        self._tasks = set()
+
+    def feed(self, token: str, update: dict):
+        if self.dispatchers is None:
+            self.api.push_update(token, update)
+            return
+        from aiogram import Bot, Dispatcher, types
+
+        async def process(dp):
+            Bot.set_current(dp.bot)
+            Dispatcher.set_current(dp)
+            await dp.updates_handler.notify(types.Update(update_id=next(_ids), **update))
+
+        task = asyncio.create_task(process(self.dispatchers[token]))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def operation(self, token: str, update: dict, wait_token: str, wait_chat: int, count: int) -> float:
+        """Feed the update and return seconds until `count` messages are sent to wait_chat"""
+        sent = self.api.wait_sent(wait_token, wait_chat, count)
+        started = time.perf_counter()
+        self.feed(token, update)
+        return await asyncio.wait_for(sent, self.timeout) - started
+
+    async def record(self, scenario: str, *steps):
+        """Run the steps (operation arguments) one by one and record their total latency"""
+        try:
+            total = 0.0
+            for step in steps:
+                total += await self.operation(*step)
+            self.latency[scenario].append(total)
+        except asyncio.TimeoutError:
+            self.errors[scenario] += 1
+
+    async def user_round(self, user: int):
+        chat_id = USER_BASE + user
+        owner_id = OWNER_BASE + user
+        last_id = random.randint(0, self.catalog_size - 11)
+
+        # catalog: 2 cards and "more"-buttons, then 5 cards and "more"-buttons
+        await self.record('catalog_open', (CLIENT_TOKEN, message_update(chat_id, text='Каталог'), CLIENT_TOKEN, chat_id, 3))
+        await self.record('catalog_more', (
+            CLIENT_TOKEN, callback_update(chat_id, f'catalog:{last_id}:5'), CLIENT_TOKEN, chat_id, 6
+        ))
+
+        await self.record(
+            'add_event',
+            (CLIENT_TOKEN, message_update(chat_id, text='Добавить событие'), CLIENT_TOKEN, chat_id, 2),
+            (CLIENT_TOKEN, message_update(chat_id, text=f'Событие {chat_id}'), CLIENT_TOKEN, chat_id, 1),
+            (CLIENT_TOKEN, message_update(chat_id, text='Заголовок'), CLIENT_TOKEN, chat_id, 1),
+            (CLIENT_TOKEN, message_update(chat_id, text='Описание'), CLIENT_TOKEN, chat_id, 1),
+            (CLIENT_TOKEN, message_update(chat_id, photo=photo()), CLIENT_TOKEN, chat_id, 1),
+            (CLIENT_TOKEN, message_update(chat_id, text='-'), CLIENT_TOKEN, chat_id, 3),
+        )
+
+        # event user + 1 belongs to owner user, so every user writes to a separate owner
+        await self.record('relay_connect', (
+            CLIENT_TOKEN, callback_update(chat_id, f'event:connect:{user + 1}'), CLIENT_TOKEN, chat_id, 1
+        ))
+        for n in range(RELAY_TEXTS):
+            await self.record('relay_text', (
+                CLIENT_TOKEN, message_update(chat_id, text=f'Сообщение {n}'), SERVICE_TOKEN, owner_id, 1
+            ))
+        await self.record('relay_photo', (
+            CLIENT_TOKEN, message_update(chat_id, photo=photo()), SERVICE_TOKEN, owner_id, 1
+        ))
+        await self.record('relay_leave', (
+            CLIENT_TOKEN, message_update(chat_id, text='/cancel', entities=[
+                {'type': 'bot_command', 'offset': 0, 'length': 7}
+            ]), CLIENT_TOKEN, chat_id, 1
+        ))
+
+    async def run_user(self, user: int, rounds: int):
+        for _ in range(rounds):
+            await self.user_round(user)
+
+    def report(self, wall_time: float) -> dict:
+        scenarios = {}
+        for scenario, values in self.latency.items():
+            values = sorted(values)
+            scenarios[scenario] = {
+                'count': len(values),
+                'errors': self.errors[scenario],
+                'throughput': round(len(values) / wall_time, 2),
+                'mean_ms': round(sum(values) / len(values) * 1000, 3),
+                'p50_ms': round(percentile(values, 50) * 1000, 3),
+                'p90_ms': round(percentile(values, 90) * 1000, 3),
+                'p99_ms': round(percentile(values, 99) * 1000, 3),
+                'max_ms': round(values[-1] * 1000, 3),
+            }
+        for scenario, errors in self.errors.items():
+            scenarios.setdefault(scenario, {'count': 0, 'errors': errors})
+        return scenarios
+
+
+def git_version() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], capture_output=True, text=True, timeout=10
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ''
+
+
+async def run(args) -> dict:
+    api = FakeBotAPI(latency=args.api_latency / 1000)
+    await api.start()
+    workdir = tempfile.mkdtemp(prefix='bot-bench-')
+    configure(api.url, f"sqlite+aiosqlite:///{os.path.join(workdir, 'bench.db')}", args.real_limits, workdir)
+
+    import main__
+    from db.engine import create_db_session
+    from services.outbound import schedulers_stats
+    logging.disable(logging.INFO)
+
+    async_sessionmaker = await create_db_session()
+    started = time.perf_counter()
+    await seed(async_sessionmaker, args.catalog_size, max(args.users, args.owners))
+    seed_time = time.perf_counter() - started
+
+    bench = Bench(api, args.catalog_size, args.timeout)
+    if args.mode == 'direct':
+        dispatchers = [main__.create_client_dispatcher(async_sessionmaker),
+                       main__.create_service_dispatcher(async_sessionmaker)]
+        bench.dispatchers = {dp.bot["token"]: dp for dp in dispatchers}
+        bots = []
+    else:
+        dispatchers = []
+        bots = [asyncio.create_task(main__.start_client_bot(async_sessionmaker)),
+                asyncio.create_task(main__.start_service_bot(async_sessionmaker))]
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(bench.run_user(user, args.rounds) for user in range(args.users)))
+        wall_time = time.perf_counter() - started
+        if bench._tasks:
+            # handlers may still be working after their messages are sent
+            await asyncio.wait(list(bench._tasks))
+        outbound = schedulers_stats()
+    finally:
+        for task in bots:
+            task.cancel()
+        await asyncio.gather(*bots, return_exceptions=True)
+        for dp in dispatchers:
+            await main__.close_dispatcher(dp)
+        await async_sessionmaker.kw['bind'].dispose()
+        await api.stop()
+
+    return {
+        'meta': {
+            'version': git_version(),
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'mode': args.mode,
+            'catalog_size': args.catalog_size,
+            'users': args.users,
+            'rounds': args.rounds,
+            'api_latency_ms': args.api_latency,
+            'real_limits': args.real_limits,
+            'seed_time': round(seed_time, 3),
+            'wall_time': round(wall_time, 3),
+        },
+        'scenarios': bench.report(wall_time),
+        'api_calls': dict(api.calls),
+        'outbound': outbound,
+    }
+
+
+def compare(result: dict, baseline: dict):
+    """Print p50/p99 of the result against the baseline"""
+    print(f"{'scenario':<16}{'p50 ms':>12}{'base':>10}{'p99 ms':>12}{'base':>10}")
+    for scenario, stats in result['scenarios'].items():
+        base = baseline.get('scenarios', {}).get(scenario, {})
+        print(f"{scenario:<16}{stats.get('p50_ms', 0):>12}{base.get('p50_ms', '-'):>10}"
+              f"{stats.get('p99_ms', 0):>12}{base.get('p99_ms', '-'):>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--catalog-size', type=int, default=10000, help='events in the seeded catalog')
+    parser.add_argument('--owners', type=int, default=100, help='owners of the seeded events')
+    parser.add_argument('--users', type=int, default=20, help='simulated users working at the same time')
+    parser.add_argument('--rounds', type=int, default=5, help='scenario rounds of every user')
+    parser.add_argument('--mode', choices=('polling', 'direct'), default='polling',
+                        help="'polling' runs start_client_bot/start_service_bot, "
+                             "'direct' passes the updates to the dispatchers as webhook mode does")
+    parser.add_argument('--api-latency', type=float, default=0.0, help='ms added to every Bot API call')
+    parser.add_argument('--real-limits', action='store_true', help='keep the outbound rate limits of config')
+    parser.add_argument('--timeout', type=float, default=30.0, help='seconds an operation may take')
+    parser.add_argument('--output', default=f"bench-{datetime.now():%Y%m%d-%H%M%S}.json", help='result JSON file')
+    parser.add_argument('--baseline', help='result JSON of a previous run to compare with')
+    args = parser.parse_args()
+    if args.catalog_size < max(args.users, args.owners, 20):
+        parser.error('--catalog-size must be at least max(--users, --owners, 20)')
+
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file_:
+            baseline = json.load(file_)
+
+    result = asyncio.run(run(args))
+    with open(output, 'w') as file_:
+        json.dump(result, file_, ensure_ascii=False, indent=2)
+    print(json.dumps(result['scenarios'], ensure_ascii=False, indent=2))
+    if baseline is not None:
+        compare(result, baseline)
+    print(f'saved to {output}')
+
+
+if __name__ == '__main__':
+    main()
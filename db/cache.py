@@ -0,0 +1,145 @@
+"""
+In-process read-through cache for event rows and their rendered captions.
+Invalidations are passed to the other processes of the worker pool by the publisher workers.py sets.
+"""
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Iterable, List, Optional
+
+
+class LRUCache:
+    """
+    Bounded LRU cache with a per-entry time to live.
+    Counts hits and misses so the cache efficiency can be observed.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Return cached value or default if the key is absent or expired.
+
+        @param key: Hashable
+        @param default: Any
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        """
+        Store value, evicting the least recently used entry above maxsize.
+
+        @param key: Hashable
+        @param value: Any
+        """
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        """Drop one entry if present"""
+        self._data.pop(key, None)
+
+    def pop_matching(self, predicate: Callable[[Any], bool]):
+        """Drop the entries whose value matches the predicate"""
+        for key in [key for key, (_, value) in self._data.items() if predicate(value)]:
+            del self._data[key]
+
+    def clear(self):
+        """Drop all entries"""
+        self._data.clear()
+
+    def stats(self) -> dict:
+        """
+        Return cache counters.
+
+        @rtype: dict
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
+
+
+event_cache = LRUCache(maxsize=4096, ttl=300.0)
+file_id_cache = LRUCache(maxsize=8192, ttl=24 * 3600.0)
+
+
+# called with the event ids dropped from the caches, e.g. to drop the routes of the events
+_listeners: List[Callable[[List[int]], None]] = []
+# sends the invalidated event ids to the other processes of the worker pool
+_publisher: Optional[Callable[[List[int]], None]] = None
+
+
+def add_invalidation_listener(listener: Callable[[List[int]], None]):
+    """Call listener(event_ids) whenever events are dropped from the caches of the process"""
+    _listeners.append(listener)
+
+
+def set_invalidation_publisher(publisher: Optional[Callable[[List[int]], None]]):
+    """Let publisher(event_ids) forward the invalidations of the process to the other processes"""
+    global _publisher
+    _publisher = publisher
+
+
+def drop_events(event_ids: List[int]):
+    """
+    Drop cached data of the events in this process only,
+    used for invalidations received from other processes.
+
+    @param event_ids: List[int]
+    """
+    for event_id in event_ids:
+        event_cache.pop(('event', event_id))
+        event_cache.pop(('render', event_id))
+    for listener in _listeners:
+        listener(event_ids)
+
+
+def invalidate_events(event_ids: Iterable[int]):
+    """
+    Drop cached data that depends on the events, in every process of the worker pool.
+    Called after any delete in event_table.
+
+    @param event_ids: Iterable[int]
+    """
+    event_ids = list(event_ids)
+    drop_events(event_ids)
+    if event_ids and _publisher is not None:
+        _publisher(event_ids)
+
+
+def invalidate_event(event_id: int):
+    """
+    Drop cached data that depends on the event.
+
+    @param event_id: int
+    """
+    invalidate_events([event_id])
+
+
+def cache_stats() -> dict:
+    """
+    Return counters of the caches by name, exported by services.metrics.
+
+    @rtype: dict
+    """
+    return {'event': event_cache.stats(), 'file_id': file_id_cache.stats()}
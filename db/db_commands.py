@@ -1,60 +1,81 @@
-from sqlalchemy import select, delete, func
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from sqlalchemy import select, delete, insert, update, func, and_, or_, text
 from sqlalchemy.orm import sessionmaker
 
-from db.models import EventTable
+from db.cache import event_cache, file_id_cache, invalidate_event, invalidate_events
+from db.models import EventTable, FileIdTable, MediaFileTable, ImportCheckpointTable, MessageLogTable
+from db.search import fts_table, sqlite_match_query, pg_document, pg_query, pg_rank
 
 
 async def db_get_item_by_id(db_session: sessionmaker, event_id: int) -> EventTable:
     """
-    Return one row from database specified by ID
+    Return one row from database specified by ID.
+    Rows are served from the event cache when possible.
 
     @param db_session: sessionmaker
 
     @rtype: EventTable
     """
+    item = event_cache.get(('event', event_id))
+    if item is not None:
+        return item
 
     sql = select(EventTable).where(EventTable.event_id == event_id)
     async with db_session() as session:
         results = await session.execute(sql)
-    return results.scalars().one()
+    item = results.scalars().one()
+    event_cache.set(('event', event_id), item)
+    return item
 
 
-async def db_get_catalog_count(db_session: sessionmaker) -> int:
+async def db_get_catalog_page(db_session: sessionmaker, last_seen_id: int, p_limit: int) -> List[EventTable]:
     """
-    Return the number of rows in the database.
+    Return up to p_limit not expired rows following last_seen_id in one query.
+    Keyset pagination: cost does not depend on how deep the page is.
 
     @param db_session: sessionmaker
+    @param last_seen_id: int event_id of the last shown item, 0 for the first page
+    @param p_limit: int
 
-    @rtype: int
+    @rtype: List[EventTable]
     """
 
-    sql = select(func.count(EventTable.event_id))
+    sql = select(EventTable).where(
+        EventTable.event_id > last_seen_id,
+        EventTable.event_end_show_date > datetime.utcnow()
+    ).order_by(EventTable.event_id.asc()).limit(p_limit)
     async with db_session() as session:
-        results = await session.scalar(sql)
-    return results
+        results = await session.execute(sql)
+
+    items = results.scalars().all()
+    for item in items:
+        event_cache.set(('event', item.event_id), item)
+    return items
 
 
-async def db_get_catalog_items(db_session: sessionmaker, p_limit: int, p_offset: int) -> EventTable:
+async def db_add_item(db_session: sessionmaker, **fields) -> EventTable:
     """
-    Return rows from the database.
+    Insert one row into the database.
+    event_id is allocated by the database, so concurrent inserts never collide.
 
     @param db_session: sessionmaker
-    @param p_limit: int
-    @param p_offset: int
+    @param fields: EventTable columns except event_id
 
     @rtype: EventTable
     """
 
-    sql = select(EventTable).order_by(EventTable.event_id.asc()).limit(p_limit).offset(p_offset)
+    item = EventTable(**fields)
     async with db_session() as session:
-        results = await session.execute(sql)
-
-    return results.scalars().one()
+        session.add(item)
+        await session.commit()
+    return item
 
 
 async def db_delete_item_by_id(db_session: sessionmaker, event_id: int):
     """
-    Delete one row from the database specified by PK event_id.
+    Delete one row from the database specified by PK event_id, with its conversations.
 
     @param db_session: sessionmaker
     @param event_id: int
@@ -62,19 +83,362 @@ async def db_delete_item_by_id(db_session: sessionmaker, event_id: int):
 
     sql = delete(EventTable).where(EventTable.event_id == event_id)
     async with db_session() as session:
+        await session.execute(delete(MessageLogTable).where(MessageLogTable.event_id == event_id))
         await session.execute(sql)
         await session.commit()
+    invalidate_event(event_id)
+
+
+async def db_get_user_events(db_session: sessionmaker, user_id: int, last_seen_id: int,
+                             p_limit: int) -> List[EventTable]:
+    """
+    Return up to p_limit events of the owner following last_seen_id, expired ones included.
 
+    @param db_session: sessionmaker
+    @param user_id: int owner
+    @param last_seen_id: int event_id of the last shown row, 0 for the first page
+    @param p_limit: int
 
-def db_get_max_event_id(db_session: sessionmaker) -> int:
+    @rtype: List[EventTable]
     """
-    Return max(event_id) from the database.
+    sql = select(EventTable).where(EventTable.user_id == user_id, EventTable.event_id > last_seen_id) \
+        .order_by(EventTable.event_id.asc()).limit(p_limit)
+    async with db_session() as session:
+        results = await session.execute(sql)
+    return results.scalars().all()
+
+
+async def db_delete_user_events(db_session: sessionmaker, user_id: int, event_ids: List[int]) -> int:
+    """
+    Delete the events of the owner in one statement, ids of other users are ignored.
+    Their conversations are deleted with them.
+
+    @param db_session: sessionmaker
+    @param user_id: int owner
+    @param event_ids: List[int]
+
+    @rtype: int number of deleted rows
+    """
+    if not event_ids:
+        return 0
+    owned = and_(EventTable.user_id == user_id, EventTable.event_id.in_(event_ids))
+    async with db_session() as session:
+        await session.execute(delete(MessageLogTable).where(
+            MessageLogTable.event_id.in_(select(EventTable.event_id).where(owned))
+        ).execution_options(synchronize_session=False))
+        results = await session.execute(delete(EventTable).where(owned))
+        await session.commit()
+    invalidate_events(event_ids)
+    return results.rowcount
+
+
+async def db_search_events(db_session: sessionmaker, query: str, cursor: Optional[Tuple[float, int]],
+                           p_limit: int) -> List[Tuple[EventTable, float]]:
+    """
+    Return up to p_limit not expired events matching the query, best first.
+    Pagination is by the cursor (rank, event_id) of the last returned row.
+
+    @param db_session: sessionmaker
+    @param query: str user input
+    @param cursor: (rank, event_id) of the last shown result, None for the first page
+    @param p_limit: int
+
+    @rtype: List[Tuple[EventTable, float]] events with their rank
+    """
+    async with db_session() as session:
+        if session.bind.dialect.name == 'postgresql':
+            rank = pg_rank(query)
+            sql = select(EventTable, rank.label('rank')).where(pg_document().op('@@')(pg_query(query)))
+        else:
+            match = sqlite_match_query(query)
+            if not match:
+                return []
+            rank = fts_table.c.rank
+            sql = select(EventTable, rank).join(fts_table, fts_table.c.rowid == EventTable.event_id) \
+                .where(text(f"{fts_table.name} MATCH :match").bindparams(match=match))
+        sql = sql.where(EventTable.event_end_show_date > datetime.utcnow())
+        if cursor is not None:
+            last_rank, last_id = cursor
+            sql = sql.where(or_(rank > last_rank, and_(rank == last_rank, EventTable.event_id > last_id)))
+        sql = sql.order_by(rank, EventTable.event_id).limit(p_limit)
+        results = (await session.execute(sql)).all()
+    for item, _ in results:
+        event_cache.set(('event', item.event_id), item)
+    return [(item, item_rank) for item, item_rank in results]
+
+
+async def db_delete_expired(db_session: sessionmaker, now: datetime, batch_size: int) -> List[int]:
+    """
+    Delete at most batch_size rows expired before now in one short transaction,
+    with their conversations.
+
+    @param db_session: sessionmaker
+    @param now: datetime UTC
+    @param batch_size: int
+
+    @rtype: List[int] deleted event_id
+    """
+
+    sql = select(EventTable.event_id).where(EventTable.event_end_show_date <= now) \
+        .order_by(EventTable.event_end_show_date.asc()).limit(batch_size)
+    async with db_session() as session:
+        event_ids = (await session.execute(sql)).scalars().all()
+        if event_ids:
+            await session.execute(delete(MessageLogTable).where(MessageLogTable.event_id.in_(event_ids)))
+            await session.execute(delete(EventTable).where(EventTable.event_id.in_(event_ids)))
+            await session.commit()
+    invalidate_events(event_ids)
+    return event_ids
+
+
+async def db_get_file_id(db_session: sessionmaker, file_unique_id: str, bot: str) -> Optional[str]:
+    """
+    Return file_id of the file on the bot or None if the file was never sent by this bot.
+
+    @param db_session: sessionmaker
+    @param file_unique_id: str
+    @param bot: str 'CLIENT_BOT' or 'SERVICE_BOT'
+
+    @rtype: str
+    """
+    file_id = file_id_cache.get((file_unique_id, bot))
+    if file_id is not None:
+        return file_id
+
+    sql = select(FileIdTable.file_id).where(
+        FileIdTable.file_unique_id == file_unique_id,
+        FileIdTable.bot == bot
+    )
+    async with db_session() as session:
+        file_id = await session.scalar(sql)
+    if file_id is not None:
+        file_id_cache.set((file_unique_id, bot), file_id)
+    return file_id
+
+
+async def db_save_file_id(db_session: sessionmaker, file_unique_id: str, bot: str, file_id: str):
+    """
+    Remember file_id of the file on the bot.
+
+    @param db_session: sessionmaker
+    @param file_unique_id: str
+    @param bot: str 'CLIENT_BOT' or 'SERVICE_BOT'
+    @param file_id: str
+    """
+    async with db_session() as session:
+        await session.merge(FileIdTable(file_unique_id=file_unique_id, bot=bot, file_id=file_id))
+        await session.commit()
+    file_id_cache.set((file_unique_id, bot), file_id)
+
+
+async def db_get_media_file(db_session: sessionmaker, file_unique_id: str) -> Optional[MediaFileTable]:
+    """
+    Return the file of the media store or None if it is not stored.
+
+    @param db_session: sessionmaker
+    @param file_unique_id: str
+
+    @rtype: MediaFileTable
+    """
+    async with db_session() as session:
+        return await session.get(MediaFileTable, file_unique_id)
+
+
+async def db_get_media_files(db_session: sessionmaker, p_limit: int) -> List[MediaFileTable]:
+    """
+    Return up to p_limit files of the media store, least recently used first.
+
+    @param db_session: sessionmaker
+    @param p_limit: int
+
+    @rtype: List[MediaFileTable]
+    """
+    sql = select(MediaFileTable).order_by(MediaFileTable.last_used.asc()).limit(p_limit)
+    async with db_session() as session:
+        results = await session.execute(sql)
+    return results.scalars().all()
+
+
+async def db_get_media_bytes(db_session: sessionmaker) -> int:
+    """
+    Return the size of all files of the media store.
 
     @param db_session: sessionmaker
 
     @rtype: int
     """
-    qry = db_session.query(func.max(EventTable.event_id).label("event_id"))
-    res = qry.one()
-    max_id = int(res.event_id) if res.event_id is not None else 1
-    return max_id
+    async with db_session() as session:
+        return await session.scalar(select(func.coalesce(func.sum(MediaFileTable.size), 0)))
+
+
+async def db_save_media_file(db_session: sessionmaker, file_unique_id: str, path: str, size: int,
+                             last_used: datetime):
+    """
+    Add or update the file in the index of the media store.
+
+    @param db_session: sessionmaker
+    @param file_unique_id: str
+    @param path: str relative to the store root
+    @param size: int bytes
+    @param last_used: datetime UTC
+    """
+    async with db_session() as session:
+        await session.merge(MediaFileTable(file_unique_id=file_unique_id, path=path, size=size, last_used=last_used))
+        await session.commit()
+
+
+async def db_touch_media_files(db_session: sessionmaker, file_unique_ids: List[str], last_used: datetime):
+    """
+    Set last_used of the files of the media store in one statement.
+
+    @param db_session: sessionmaker
+    @param file_unique_ids: List[str]
+    @param last_used: datetime UTC
+    """
+    sql = update(MediaFileTable).where(MediaFileTable.file_unique_id.in_(file_unique_ids)) \
+        .values(last_used=last_used)
+    async with db_session() as session:
+        await session.execute(sql)
+        await session.commit()
+
+
+async def db_delete_media_files(db_session: sessionmaker, file_unique_ids: List[str]):
+    """
+    Remove the files from the index of the media store in one statement.
+
+    @param db_session: sessionmaker
+    @param file_unique_ids: List[str]
+    """
+    sql = delete(MediaFileTable).where(MediaFileTable.file_unique_id.in_(file_unique_ids))
+    async with db_session() as session:
+        await session.execute(sql)
+        await session.commit()
+
+
+async def db_insert_events(db_session: sessionmaker, rows: List[dict], batch_size: int,
+                           source: Optional[str] = None, position: int = 0,
+                           size: Optional[int] = None, mtime_ns: Optional[int] = None):
+    """
+    Insert the rows with multi-row INSERT statements of batch_size rows in one transaction.
+    With source the import checkpoint is stored in the same transaction,
+    so a resumed import never inserts a row twice.
+
+    @param db_session: sessionmaker
+    @param rows: List[dict] EventTable columns, every row has the same keys
+    @param batch_size: int rows per statement
+    @param source: str imported file or None
+    @param position: int input records consumed including these rows
+    @param size: int size of the imported file
+    @param mtime_ns: int modification time of the imported file
+    """
+    async with db_session() as session:
+        for start in range(0, len(rows), batch_size):
+            await session.execute(insert(EventTable).values(rows[start:start + batch_size]))
+        if source is not None:
+            checkpoint = await session.get(ImportCheckpointTable, source)
+            imported = (checkpoint.imported if checkpoint is not None else 0) + len(rows)
+            await session.merge(ImportCheckpointTable(source=source, size=size, mtime_ns=mtime_ns, position=position,
+                                                      imported=imported, updated=datetime.utcnow()))
+        await session.commit()
+
+
+async def db_get_import_checkpoint(db_session: sessionmaker, source: str) -> Optional[ImportCheckpointTable]:
+    """
+    Return progress of the import of the source or None if it was not started.
+
+    @param db_session: sessionmaker
+    @param source: str
+
+    @rtype: ImportCheckpointTable
+    """
+    async with db_session() as session:
+        return await session.get(ImportCheckpointTable, source)
+
+
+async def db_delete_import_checkpoint(db_session: sessionmaker, source: str):
+    """
+    Forget progress of the import of the source.
+
+    @param db_session: sessionmaker
+    @param source: str
+    """
+    async with db_session() as session:
+        await session.execute(delete(ImportCheckpointTable).where(ImportCheckpointTable.source == source))
+        await session.commit()
+
+
+async def db_sync_event_id_sequence(db_session: sessionmaker):
+    """
+    Move the PostgreSQL sequence of event_id past the largest event_id,
+    needed after rows were inserted with explicit event_id. SQLite needs nothing.
+
+    @param db_session: sessionmaker
+    """
+    async with db_session() as session:
+        if session.bind.dialect.name != 'postgresql':
+            return
+        await session.execute(text(
+            "SELECT setval(pg_get_serial_sequence('event_table', 'event_id'), "
+            "COALESCE((SELECT max(event_id) FROM event_table), 0) + 1, false)"
+        ))
+        await session.commit()
+
+
+async def db_export_events(db_session: sessionmaker, last_seen_id: int, p_limit: int,
+                           active_only: bool = False) -> List[dict]:
+    """
+    Return up to p_limit rows following last_seen_id as dicts, keyset pagination.
+    Rows are not cached, an export reads the whole table once.
+
+    @param db_session: sessionmaker
+    @param last_seen_id: int event_id of the last exported row, 0 for the first page
+    @param p_limit: int
+    @param active_only: bool skip expired rows
+
+    @rtype: List[dict]
+    """
+    sql = select(EventTable.__table__).where(EventTable.event_id > last_seen_id)
+    if active_only:
+        sql = sql.where(EventTable.event_end_show_date > datetime.utcnow())
+    sql = sql.order_by(EventTable.event_id.asc()).limit(p_limit)
+    async with db_session() as session:
+        results = await session.execute(sql)
+    return [dict(row) for row in results.mappings()]
+
+
+async def db_add_messages(db_session: sessionmaker, rows: List[dict]):
+    """
+    Append the relayed messages to the message log with one multi-row INSERT.
+
+    @param db_session: sessionmaker
+    @param rows: List[dict] MessageLogTable columns except message_id, every row has the same keys
+    """
+    async with db_session() as session:
+        await session.execute(insert(MessageLogTable).values(rows))
+        await session.commit()
+
+
+async def db_get_conversation(db_session: sessionmaker, event_id: int, client_chat_id: int,
+                              before_id: Optional[int], p_limit: int) -> List[MessageLogTable]:
+    """
+    Return up to p_limit messages of the conversation preceding before_id, newest first.
+    Keyset pagination over ix_message_log_conversation.
+
+    @param db_session: sessionmaker
+    @param event_id: int
+    @param client_chat_id: int chat of the client bot user
+    @param before_id: int message_id of the oldest shown message, None for the latest page
+    @param p_limit: int
+
+    @rtype: List[MessageLogTable]
+    """
+    sql = select(MessageLogTable).where(
+        MessageLogTable.event_id == event_id,
+        MessageLogTable.client_chat_id == client_chat_id
+    )
+    if before_id is not None:
+        sql = sql.where(MessageLogTable.message_id < before_id)
+    sql = sql.order_by(MessageLogTable.message_id.desc()).limit(p_limit)
+    async with db_session() as session:
+        results = await session.execute(sql)
+    return results.scalars().all()
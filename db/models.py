@@ -1,21 +1,25 @@
 """
 Data model declaration
 """
-from sqlalchemy import Column, BigInteger, String
+from sqlalchemy import Column, BigInteger, DateTime, Index, Integer, String, Text
 
 from db.base import Base
 
 
 class EventTable(Base):
     __tablename__ = "event_table"
+    # serves the owner's events ordered by event_id;
+    # AUTOINCREMENT keeps SQLite from reusing the id of a deleted newest event
+    __table_args__ = (Index('ix_event_table_user_event', 'user_id', 'event_id'), {'sqlite_autoincrement': True})
 
-    event_id = Column(BigInteger, primary_key=True)
+    # SQLite autoincrements only INTEGER PRIMARY KEY (an alias of rowid)
+    event_id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
     user_id = Column(BigInteger)
     event_name = Column(String(50))
     event_header = Column(String(150))
     event_description = Column(String(300))
     event_media = Column(String(150))
-    event_end_show_date = Column(String(50))    
+    event_end_show_date = Column(DateTime, nullable=False, index=True)  # UTC, hidden from catalog after it
 
     def __repr__(self):
         return "<Event(\
@@ -35,3 +39,79 @@ class EventTable(Base):
                             self.event_media,
                             self.event_end_show_date,
                             )
+
+
+class FileIdTable(Base):
+    """
+    file_id of a file on the bot it was relayed to.
+    file_unique_id is the same for every bot, file_id is not.
+    """
+    __tablename__ = "file_id_table"
+
+    file_unique_id = Column(String(100), primary_key=True)
+    bot = Column(String(20), primary_key=True)
+    file_id = Column(String(200))
+
+
+class FsmSessionTable(Base):
+    """
+    FSM session of one user in one chat of one bot.
+    The chat with the pair bot is described by peer_chat_id and event_id,
+    other FSM data (e.g. the draft of a new event) is kept as JSON in data.
+    """
+    __tablename__ = "fsm_session_table"
+
+    bot = Column(String(20), primary_key=True)
+    chat = Column(String(32), primary_key=True)
+    user = Column(String(32), primary_key=True)
+    state = Column(String(100))
+    peer_chat_id = Column(BigInteger)
+    event_id = Column(BigInteger)
+    data = Column(Text)
+
+
+class MediaFileTable(Base):
+    """
+    File of the media store on disk, keyed by file_unique_id which is the same for every bot.
+    """
+    __tablename__ = "media_file_table"
+
+    file_unique_id = Column(String(100), primary_key=True)
+    path = Column(String(255))  # relative to the store root
+    size = Column(BigInteger)
+    last_used = Column(DateTime, index=True)
+
+
+class ImportCheckpointTable(Base):
+    """
+    Progress of a bulk import, committed with the rows it counts.
+    """
+    __tablename__ = "import_checkpoint_table"
+
+    source = Column(String(255), primary_key=True)  # absolute path of the imported file
+    size = Column(BigInteger)  # of the file when the import started, a changed file is not resumed
+    mtime_ns = Column(BigInteger)
+    position = Column(BigInteger)  # input records consumed
+    imported = Column(BigInteger)  # rows inserted
+    updated = Column(DateTime)
+
+
+class MessageLogTable(Base):
+    """
+    Message relayed between the bots, rows are appended and deleted with their event.
+    A conversation is an event and the chat of the client bot user about it.
+    """
+    __tablename__ = "message_log_table"
+    # serves the history of a conversation ordered by message_id
+    __table_args__ = (Index('ix_message_log_conversation', 'event_id', 'client_chat_id', 'message_id'),)
+
+    message_id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+    bot = Column(String(20))  # bot the message was sent to
+    sender_chat_id = Column(BigInteger)
+    recipient_chat_id = Column(BigInteger)
+    client_chat_id = Column(BigInteger)
+    event_id = Column(BigInteger)
+    content_type = Column(String(20))
+    file_unique_id = Column(String(100))
+    text = Column(Text)
+    created = Column(DateTime)  # UTC
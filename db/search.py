@@ -0,0 +1,91 @@
+"""
+Full-text index of the events.
+SQLite: FTS5 external content table over event_table kept in sync by triggers.
+PostgreSQL: GIN index over the tsvector of the same columns.
+Both give a rank where a lower value is a better match.
+"""
+import re
+
+from sqlalchemy import column, func, literal_column, table, text
+
+FTS_TABLE = 'event_fts'
+SEARCH_COLUMNS = ('event_name', 'event_header', 'event_description')
+PG_TS_CONFIG = "'russian'::regconfig"
+
+fts_table = table(FTS_TABLE, column('rowid'), column('rank'))
+
+_columns = ', '.join(SEARCH_COLUMNS)
+_new_columns = ', '.join(f'new.{name}' for name in SEARCH_COLUMNS)
+_old_columns = ', '.join(f'old.{name}' for name in SEARCH_COLUMNS)
+
+SQLITE_DDL = (
+    f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5({_columns}, "
+    f"content='event_table', content_rowid='event_id', tokenize='unicode61 remove_diacritics 2')",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON event_table BEGIN "
+    f"INSERT INTO {FTS_TABLE}(rowid, {_columns}) VALUES (new.event_id, {_new_columns}); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON event_table BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {_columns}) VALUES ('delete', old.event_id, {_old_columns}); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE ON event_table BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {_columns}) VALUES ('delete', old.event_id, {_old_columns}); "
+    f"INSERT INTO {FTS_TABLE}(rowid, {_columns}) VALUES (new.event_id, {_new_columns}); END",
+    # index the events created before the search was added
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')",
+)
+
+_pg_document = " || ' ' || ".join(f"coalesce({name}, '')" for name in SEARCH_COLUMNS)
+PG_DDL = (
+    f"CREATE INDEX IF NOT EXISTS event_table_search_idx ON event_table "
+    f"USING GIN (to_tsvector({PG_TS_CONFIG}, {_pg_document}))",
+)
+
+
+def create_search_index(connection):
+    """
+    Create the full-text index if it does not exist. Run with AsyncConnection.run_sync.
+
+    @param connection: sqlalchemy.engine.Connection
+    """
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        exists = connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': FTS_TABLE}
+        ).first()
+        if not exists:
+            for statement in SQLITE_DDL:
+                connection.execute(text(statement))
+    elif dialect == 'postgresql':
+        for statement in PG_DDL:
+            connection.execute(text(statement))
+
+
+def sqlite_match_query(query: str) -> str:
+    """
+    Return FTS5 MATCH expression finding the events containing all words of the query,
+    the words are quoted so user input can not break the FTS5 syntax.
+    The last word is matched as prefix, the user may not have typed it to the end.
+
+    @param query: str user input
+
+    @rtype: str empty if the query has no words
+    """
+    words = re.findall(r'\w+', query)
+    if not words:
+        return ''
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def pg_document():
+    """Return tsvector expression of the events, the same as in the GIN index"""
+    return func.to_tsvector(literal_column(PG_TS_CONFIG), literal_column(_pg_document))
+
+
+def pg_query(query: str):
+    """Return tsquery of the user input"""
+    return func.plainto_tsquery(literal_column(PG_TS_CONFIG), query)
+
+
+def pg_rank(query: str):
+    """Return rank of the events for the user input, lower is better as with FTS5 bm25"""
+    return -func.ts_rank(pg_document(), pg_query(query))
@@ -1,15 +1,26 @@
 """
 The module provides functions for displaying navigation in the event catalog
 """
+from typing import List
+
 from aiogram import types, Dispatcher
 
-from db.db_commands import db_get_catalog_items, db_get_catalog_count, db_delete_item_by_id
+import config
+
+from db.db_commands import db_get_catalog_page, db_delete_item_by_id
+from db.models import EventTable
 import handlers.keyboards as keyb
+import handlers.render as render
+from services.outbound import answer, own_scheduler, PRIORITY_CATALOG
+
+
+CATALOG_FIRST_PAGE = 2  # number of items to show on catalog open
+MEDIA_GROUP_LIMIT = 10  # Bot API limit of items in one media group
 
 
-async def catalog_show_event(message: types.Message, offset: int):
+async def catalog_show_event(message: types.Message, item: EventTable):
     """
-    Get one event from catalog and send message chat in format:
+    Send one catalog event to chat in format:
     {photo}
     {event_id}
     {event_header}
@@ -17,18 +28,15 @@ async def catalog_show_event(message: types.Message, offset: int):
     ['Связаться','Удалить событие']
 
     @param message: aiogram.types.Massage
-    @param offset: int
+    @param item: EventTable
     """
-    item = await db_get_catalog_items(message.bot.get("db"), 1, offset)
-    caption = f'Событие#:{item.event_id}\n' + \
-              f'Заголовок: {item.event_header}\n' + \
-              f'Описание: {item.event_description}\n'
+    caption = render.render_event(item).caption
+    keyboard = render.CATALOG_OWNER if item.user_id == message.chat.id else render.CATALOG_OTHER
 
-    is_owner = item.user_id == message.chat.id
-    keyboard = keyb.keyboard_catalog_get(is_owner)
-
-    await message.bot.send_photo(
-        chat_id=message.chat.id,
+    own_scheduler(message.bot).submit(
+        'send_photo',
+        message.chat.id,
+        PRIORITY_CATALOG,
         photo=item.event_media,
         caption=caption,
         parse_mode="HTML",
@@ -36,50 +44,96 @@ async def catalog_show_event(message: types.Message, offset: int):
     )
 
 
-async def catalog_index(message: types.Message):
+async def catalog_show_media_group(message: types.Message, items: List[EventTable], remaining: int):
     """
-    form catalog. send first two items of catalog and "more"-buttons ['+1','+5'] to chat.
+    Send catalog events as one album (up to 10 items) followed by one compact keyboard
+    with per-item ['Связаться #id','Удалить #id'] and "more"-buttons.
 
     @param message: aiogram.types.Massage
+    @param items: List[EventTable]
+    @param remaining: int amount of items after the page
     """
-    items_count = await db_get_catalog_count(message.bot.get("db"))
-    if items_count <= 0:
-        await message.answer('Каталог пуст.', reply_markup=keyb.keyboard_reply_get(keyb.KEYBOARD_MAIN))
-        return
+    for start in range(0, len(items), MEDIA_GROUP_LIMIT):
+        media = types.MediaGroup()
+        for item in items[start:start + MEDIA_GROUP_LIMIT]:
+            media.attach_photo(item.event_media, caption=render.render_event(item).caption, parse_mode="HTML")
+        own_scheduler(message.bot).submit('send_media_group', message.chat.id, PRIORITY_CATALOG, media=media)
+
+    keyboard = render.catalog_group_markup(items, message.chat.id, remaining)
+    own_scheduler(message.bot).submit(
+        'send_message', message.chat.id, PRIORITY_CATALOG, text='Выберите событие', reply_markup=keyboard
+    )
+
+
+async def catalog_show_page(message: types.Message, last_seen_id: int, amount: int) -> bool:
+    """
+    Send `amount` catalog items following last_seen_id and "more"-buttons ['+1','+5'] to chat.
+    One query fetches the page together with a lookahead used to decide which buttons to show.
+
+    @param message: aiogram.types.Massage
+    @param last_seen_id: int
+    @param amount: int
+
+    @rtype: bool False if there was nothing to show
+    """
+    lookahead = max(keyb.CATALOG_MORE_AMOUNTS)
+    items = await db_get_catalog_page(message.bot.get("db"), last_seen_id, amount + lookahead)
+    page, rest = items[:amount], items[amount:]
+    if getattr(config, 'CATALOG_RENDER_MODE', 'photo') == 'media_group' and len(page) > 1:
+        await catalog_show_media_group(message, page, len(rest))
+        return True
+
+    for item in page:
+        await catalog_show_event(message, item)
 
-    offset = 2  # number of items to show
-    for offset in range(offset):
-        await catalog_show_event(message, offset)
+    if page and rest:
+        keyboard = keyb.keyboard_catalog_show_more(page[-1].event_id, len(rest))
+        own_scheduler(message.bot).submit(
+            'send_message', message.chat.id, PRIORITY_CATALOG, text='Показать больше', reply_markup=keyboard
+        )
+    return bool(page)
 
-    if items_count > offset+1:
-        keyboard = keyb.keyboard_catalog_show_more(items_count, offset)
-        await message.answer('Показать больше', reply_markup=keyboard)
+
+async def catalog_index(message: types.Message):
+    """
+    form catalog. send first two items of catalog and "more"-buttons ['+1','+5'] to chat.
+
+    @param message: aiogram.types.Massage
+    """
+    if not await catalog_show_page(message, 0, CATALOG_FIRST_PAGE):
+        answer(message, 'Каталог пуст.', reply_markup=render.REPLY_MAIN)
 
 
 async def catalog_page_handler(query: types.CallbackQuery, callback_data: dict):
     """
-    Show +1 or +5 catalog items according to pressed "more"-button
+    Show +1 or +5 catalog items after the last shown one according to pressed "more"-button
 
     @param query: types.CallbackQuery
     @param callback_data: dict
     """
-    items_count = await db_get_catalog_count(query.bot.get("db"))
-    page = int(callback_data.get("page"))
-    to_page = int(callback_data.get("to_page"))
-    for offset in range(page + 1, to_page + 1):
-        await catalog_show_event(query.message, offset)
-
-    if items_count > to_page + 1:
-        keyboard = keyb.keyboard_catalog_show_more(items_count, to_page)
-        await query.message.answer('Показать больше', reply_markup=keyboard)
+    last_id = int(callback_data.get("last_id"))
+    amount = int(callback_data.get("amount"))
+    if amount not in keyb.CATALOG_MORE_AMOUNTS:
+        return
+    if not await catalog_show_page(query.message, last_id, amount):
+        answer(query.message, 'Больше событий нет.')
 
 
 async def catalog_delete_event_confirmation_handler(query: types.CallbackQuery):
     """Delete confirmation dialog"""
     event_id = query.message.html_text.split(f'\n')[0]
     event_id = int(event_id[event_id.find(':') + 1:])
-    keyboard = keyb.keyboard_catalog_delete_confirmation()
-    await query.message.answer(f'Вы дейтвительно хотите удалить событие? #{event_id}', reply_markup=keyboard)
+    await catalog_ask_delete_confirmation(query.message, event_id)
+
+
+async def catalog_delete_item_handler(query: types.CallbackQuery, callback_data: dict):
+    """Delete confirmation dialog for a button of the compact media group keyboard"""
+    await catalog_ask_delete_confirmation(query.message, int(callback_data.get("event_id")))
+
+
+async def catalog_ask_delete_confirmation(message: types.Message, event_id: int):
+    keyboard = render.DELETE_CONFIRMATION
+    answer(message, f'Вы дейтвительно хотите удалить событие? #{event_id}', reply_markup=keyboard)
 
 
 async def catalog_delete_event_handler(query: types.CallbackQuery):
@@ -88,7 +142,7 @@ async def catalog_delete_event_handler(query: types.CallbackQuery):
     """
     event_id = int(query.message.html_text.split(f'#')[1])
     await db_delete_item_by_id(query.bot.get("db"), event_id)
-    await query.message.answer(f'Событие {event_id} удалено')
+    answer(query.message, f'Событие {event_id} удалено')
     await catalog_index(query.message)
 
 async def catalog_return_to_catalog(query: types.CallbackQuery):
@@ -101,4 +155,5 @@ def register_catalog_handlers(dp: Dispatcher):
     dp.register_callback_query_handler(catalog_delete_event_handler, lambda c: c.data == 'delete_event')
     dp.register_callback_query_handler(catalog_return_to_catalog, lambda c: c.data == 'cancel_delete')
     dp.register_callback_query_handler(catalog_delete_event_confirmation_handler, lambda c: c.data == 'delete_event_confirmation')
+    dp.register_callback_query_handler(catalog_delete_item_handler, keyb.event_callback.filter(action='delete'))
     dp.register_callback_query_handler(catalog_page_handler, keyb.catalog_callback.filter())
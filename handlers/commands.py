@@ -1,7 +1,9 @@
 from aiogram import types, Dispatcher
+from sqlalchemy.exc import NoResultFound
 
-import handlers.keyboards as keyb
+import handlers.render as render
 from db.db_commands import db_get_item_by_id
+from services.outbound import answer, own_scheduler
 
 
 async def cmd_start(message: types.Message):
@@ -11,21 +13,25 @@ async def cmd_start(message: types.Message):
     unique_code = extract_unique_code(message.text)
     if unique_code:  # if the '/start' command contains a unique_code
         event_id = int(unique_code[unique_code.find('_') + 1:])
-        item = await db_get_item_by_id(message.bot.get("db"), event_id)
-        caption = f'Событие#:{item.event_id}\n' + \
-                  f'Заголовок: {item.event_header}\n' + \
-                  f'Описание: {item.event_description}\n'
-        await message.bot.send_photo(
-            chat_id=message.chat.id,
+        try:
+            item = await db_get_item_by_id(message.bot.get("db"), event_id)
+        except NoResultFound:
+            answer(message, "Событие удалено.", reply_markup=render.REPLY_MAIN)
+            return
+        caption = render.render_event(item).caption
+        own_scheduler(message.bot).submit(
+            'send_photo',
+            message.chat.id,
             photo=item.event_media,
             caption=caption,
             parse_mode="HTML",
             # reply_markup=types.ReplyKeyboardRemove()
         )
     else:
-        await message.answer(
+        answer(
+            message,
             f"Добро пожаловать, {message.from_user.full_name}",
-            reply_markup=keyb.keyboard_reply_get(keyb.KEYBOARD_MAIN))
+            reply_markup=render.REPLY_MAIN)
 
 
 def extract_unique_code(text):
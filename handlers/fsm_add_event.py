@@ -1,8 +1,12 @@
 """
-This module describes a state machine for adding events to the database
+This module describes a state machine for adding events to the database.
+The owner sets the last day the event is shown in the catalog or takes the default
+of config.EVENT_SHOW_DAYS days; expired events are deleted by services.expiry.
 """
 
-import logging.config
+import logging
+from datetime import datetime, time, timedelta
+
 from aiogram import Dispatcher, types
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters import Text
@@ -10,13 +14,16 @@ from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.types.message import ContentType
 
 
-from db.db_commands import db_get_max_event_id
-from db.models import EventTable
-import handlers.keyboards as keyb
+from db.db_commands import db_add_item
+import config
+import handlers.render as render
+from services.media_store import media_store
+from services.outbound import answer, own_scheduler
 
-logging.config.fileConfig(fname=r'logger.ini', disable_existing_loggers=False)
 logger = logging.getLogger(__name__)
 
+EVENT_SHOW_DAYS = getattr(config, 'EVENT_SHOW_DAYS', 30)
+
 
 # States
 class Form(StatesGroup):
@@ -31,13 +38,14 @@ async def add_event(message: types.Message):
     """
     Conversation's entry point
     """
-    await message.answer(
+    answer(
+        message,
         f"Вы создаете событие:",
-        reply_markup=keyb.keyboard_reply_get(keyb.KEYBOARD_CANCEL))
+        reply_markup=render.REPLY_CANCEL)
 
     # Set state
     await Form.event_name.set()
-    await message.answer("Имя события")
+    answer(message, "Имя события")
 
 
 async def process_event_name(message: types.Message, state: FSMContext):
@@ -48,7 +56,7 @@ async def process_event_name(message: types.Message, state: FSMContext):
         data['event_name'] = message.text
 
     await Form.next()
-    await message.answer("Заголовок:")
+    answer(message, "Заголовок:")
 
 
 async def process_header(message: types.Message, state: FSMContext):
@@ -56,7 +64,7 @@ async def process_header(message: types.Message, state: FSMContext):
     await Form.next()
     await state.update_data(event_header=message.text)
 
-    await message.answer("Описание:")
+    answer(message, "Описание:")
 
 
 async def process_description(message: types.Message, state: FSMContext):
@@ -64,53 +72,74 @@ async def process_description(message: types.Message, state: FSMContext):
     await Form.next()
     await state.update_data(event_description=message.text)
 
-    await message.answer("Медиа")
+    answer(message, "Медиа")
 
 
 async def process_media(message: types.Message, state: FSMContext):
     """
     Process media file.
-    Save media to disk.
-    Save data from FSM to DB.
-    Send FSM data to chat.
-    Finish FSM.
+    Save media to the media store and ask for the last day of showing.
     """
     logger.info('enter to process_media func')
     await state.update_data(event_media=message.photo[-1].file_id)
-    await message.photo[-1].download()
-    await state.update_data(event_end_show_date='')
+    await media_store(message.bot.get("db")).fetch(message.photo[-1])
+
+    await Form.next()
+    answer(message, f"Последний день показа (ДД.ММ.ГГГГ, UTC) или «-», чтобы показывать {EVENT_SHOW_DAYS} дней")
+
+
+def parse_end_show_date(text: str) -> datetime:
+    """
+    Return event_end_show_date of the owner's answer, ValueError if it is not a future date.
+
+    @param text: str 'DD.MM.YYYY' last day of showing or '-' for EVENT_SHOW_DAYS days
 
+    @rtype: datetime UTC
+    """
+    text = text.strip()
+    if text == '-':
+        return datetime.utcnow() + timedelta(days=EVENT_SHOW_DAYS)
+    end = datetime.combine(datetime.strptime(text, '%d.%m.%Y').date(), time.max)
+    if end <= datetime.utcnow():
+        raise ValueError('date is in the past')
+    return end
+
+
+async def process_end_show_date(message: types.Message, state: FSMContext):
+    """
+    Process the last day of showing.
+    Save data from FSM to DB.
+    Send FSM data to chat.
+    Finish FSM.
+    """
+    try:
+        event_end_show_date = parse_end_show_date(message.text)
+    except ValueError:
+        answer(message, "Введите будущую дату в виде ДД.ММ.ГГГГ, например 31.12.2030, или «-»")
+        return
     user_data = await state.get_data()
-    db_session = message.bot.get("db")
-
-    async with db_session() as session:
-        async with session.begin():
-            max_id = await session.run_sync(db_get_max_event_id)
-        new_event_id = max_id + 1
-
-        await session.merge(
-            EventTable(
-                event_id=new_event_id,
-                user_id=message.from_user.id,
-                event_name=user_data['event_name'],
-                event_header=user_data['event_header'],
-                event_description=user_data['event_description'],
-                event_media=user_data['event_media'],
-                event_end_show_date=user_data['event_end_show_date']
-            )
-        )
-        await session.commit()
-
-    await message.answer_photo(user_data['event_media'])
-    await message.answer(
+    item = await db_add_item(
+        message.bot.get("db"),
+        user_id=message.from_user.id,
+        event_name=user_data['event_name'],
+        event_header=user_data['event_header'],
+        event_description=user_data['event_description'],
+        event_media=user_data['event_media'],
+        event_end_show_date=event_end_show_date
+    )
+    render.render_event(item)
+
+    own_scheduler(message.bot).submit('send_photo', message.chat.id, photo=user_data['event_media'])
+    answer(
+        message,
         f"Имя: {user_data['event_name']}\n" +
         f"Заголовок: {user_data['event_header']}\n" +
         f"Описание: {user_data['event_description']}\n" +
-        f"Дата окончания показа:{user_data['event_end_show_date']}",
-        reply_markup=keyb.keyboard_reply_get(keyb.KEYBOARD_MAIN))
-    await message.answer(f"Вы создали событие👆👆👆\n" +
-                         f"Для того, что бы получать уведомления о сообщениях перейдите в \n" +
-                         f"@test_211009_server_bot")
+        f"Дата окончания показа: {event_end_show_date:%d.%m.%Y}",
+        reply_markup=render.REPLY_MAIN)
+    answer(message, f"Вы создали событие👆👆👆\n" +
+                    f"Для того, что бы получать уведомления о сообщениях перейдите в \n" +
+                    f"@test_211009_server_bot")
     # Finish conversation
     await state.finish()
 
@@ -119,7 +148,7 @@ async def unknown_message(msg: types.Message):
     """
     informs the user if he sent unsupported media
     """
-    await msg.reply('Я не знаю, что с этим делать, пришлите Фото')
+    answer(msg, 'Я не знаю, что с этим делать, пришлите Фото', reply_to_message_id=msg.message_id)
 
 
 async def cancel_handler(message: types.Message, state: FSMContext):
@@ -133,7 +162,7 @@ async def cancel_handler(message: types.Message, state: FSMContext):
     logger.info('Cancelling state %r', current_state)
     # Cancel state and inform user about it
     await state.finish()
-    await message.answer("Cancelled.", reply_markup=keyb.keyboard_reply_get(keyb.KEYBOARD_MAIN), parse_mode="HTML")
+    answer(message, "Cancelled.", reply_markup=render.REPLY_MAIN, parse_mode="HTML")
 
 
 def register_handlers_add_event(dp: Dispatcher):
@@ -160,3 +189,4 @@ def register_handlers_add_event(dp: Dispatcher):
         content_types=ContentType.ANY,
         state=Form.event_media
     )
+    dp.register_message_handler(process_end_show_date, state=Form.event_end_show_date)
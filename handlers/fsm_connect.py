@@ -1,22 +1,26 @@
 """
 This module describes a state machine for chat with event owner
 """
-import logging.config
-import os
+import logging
 
 from aiogram import Dispatcher, types
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters import Text
 from aiogram.dispatcher.filters.state import State, StatesGroup
-from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.types.message import ContentType
+from sqlalchemy.exc import NoResultFound
 
-import config
 from db.db_commands import db_get_item_by_id
 import handlers.keyboards as keyb
+import handlers.render as render
+from services.album import collect_album
+from services.coalesce import coalescing, collect_text, flush_text
+from services.message_log import message_log
+from services.outbound import answer, own_scheduler, pair_scheduler, PRIORITY_RELAY
+from services.relay import relay_media
+from services.routing import build_route, drop_route, find_route, get_route
 
 
-logging.config.fileConfig(fname=r'logger.ini', disable_existing_loggers=False)
 logger = logging.getLogger(__name__)
 
 
@@ -24,49 +28,74 @@ class Form(StatesGroup):
     chat_data = State()
 
 
-async def connect_user(query: types.CallbackQuery, state: FSMContext):
-    async def create_connection(query: types.CallbackQuery, state: FSMContext):
-        await Form.chat_data.set()
-        await state.update_data(chat_data=query)
+def query_event_id(query: types.CallbackQuery, callback_data: dict = None) -> int:
+    """
+    Return event_id the user wants to connect about.
+    It is taken from the callback data of the compact catalog keyboard
+    or from the caption of the catalog card.
+    """
+    if callback_data:
+        return int(callback_data.get("event_id"))
+    event_id = query.message.caption.split(f'\n')[0]
+    return int(event_id[event_id.find(':') + 1:])
 
-        if query.message.bot.data["bot"] == 'CLIENT_BOT':
-            event_id = query.message.caption.split(f'\n')[1]
-            event_title = event_id[event_id.find(':') + 1:]
-            text_ = f"Вы вошли в чат с владельцем события:{event_title}"
-            keyboard = keyb.keyboard_reply_get(keyb.KEYBOARD_CHAT)
-        else:
-            keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
-            keyboard.add(f"❌Выйти из чата c:" + query.message.html_text.split('\n')[1].split(':')[0])
-            text_ = f"Вы вошли в чат с:" + query.message.html_text.split('\n')[1].split(':')[0]
-        return text_,keyboard
 
+async def connect_user(query: types.CallbackQuery, state: FSMContext, callback_data: dict = None):
+    """
+    Open chat with the user of the pair bot.
+    Only peer_chat_id and event_id of the chat are kept in FSM data,
+    the route of the chat is built here once for all relayed messages.
+    """
+    if query.message.bot.data["bot"] == 'CLIENT_BOT':
+        event_id = query_event_id(query, callback_data)
+        try:
+            item = await db_get_item_by_id(query.bot.get("db"), event_id)
+        except NoResultFound:
+            answer(query.message, "Событие удалено.")
+            return
+        peer_chat_id = item.user_id
+        peer_name = "владельцем события: " + item.event_header
+    else:
+        # answeruser_{chat_id}_{event_id}, buttons sent by older versions have no event_id
+        _, peer_chat_id, *event_id = query.data.split('_')
+        peer_chat_id = int(peer_chat_id)
+        peer_route = find_route('CLIENT_BOT', peer_chat_id)
+        if event_id:
+            event_id = int(event_id[0])
+        elif peer_route is not None:
+            event_id = peer_route.event_id
+        else:
+            answer(query.message, "Кнопка устарела, ответьте на следующее сообщение пользователя.")
+            return
+        peer_name = ": " + (peer_route.sender_name if peer_route else str(peer_chat_id))
 
-    if not bool(await state.get_data()):
-        text_, keyboard = await create_connection(query, state)
+    state_data = await state.get_data()
+    if state_data.get('peer_chat_id') == peer_chat_id and state_data.get('event_id') == event_id:
+        keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
+        keyboard.add(f"❌Выйти из чата c " + peer_name)
+        keyboard.add("История")
+        text_ = f"Вы уже в чате с " + peer_name
     else:
-        state_data = await state.get_data()
+        await state.finish()
+        await Form.chat_data.set()
+        await state.update_data(peer_chat_id=peer_chat_id, event_id=event_id)
+        await build_route(query.bot, query.message.chat.id, query.from_user.full_name, peer_chat_id, event_id)
         if query.message.bot.data["bot"] == 'CLIENT_BOT':
-            event_id = state_data['chat_data'].message.caption.split(f'\n')[1]
-            old_query_name = "владельцем события: "+event_id[event_id.find(':') + 1:]
-            event_id = query.message.caption.split(f'\n')[1]
-            new_query_name = "владельцем события: "+event_id[event_id.find(':') + 1:]
+            keyboard = render.REPLY_CHAT
+            text_ = f"Вы вошли в чат с " + peer_name
         else:
-            old_query_name = ": " + state_data['chat_data'].message.html_text.split('\n')[1].split(':')[0]
-            new_query_name = ": " + query.message.html_text.split('\n')[1].split(':')[0]
-
-        if old_query_name == new_query_name:
             keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
-            keyboard.add(f"❌Выйти из чата c " + new_query_name)
-            text_ = f"Вы уже в чате с " + new_query_name
-        else:
-            await state.finish()
-            text_, keyboard = await create_connection(query, state)
+            keyboard.add(f"❌Выйти из чата c" + peer_name)
+            keyboard.add("История")
+            text_ = f"Вы вошли в чат с" + peer_name
 
-    await query.message.answer(
+    answer(
+        query.message,
         text_,
         reply_markup=keyboard
     )
 
+
 async def connect_cancel(message: types.Message, state: FSMContext):
     """
     Allow user to cancel any action
@@ -76,92 +105,66 @@ async def connect_cancel(message: types.Message, state: FSMContext):
         return
 
     await state.finish()
-    await message.reply('Cancelled.', reply_markup=types.ReplyKeyboardRemove())
+    drop_route(message.bot.data["bot"], message.chat.id)
+    answer(message, 'Cancelled.', reply_to_message_id=message.message_id, reply_markup=types.ReplyKeyboardRemove())
+
+
+def log_message(message: types.Message, route):
+    """Add the message relayed by the route to the message log, the relay does not wait for it"""
+    client_chat_id = message.chat.id if message.bot.data["bot"] == 'CLIENT_BOT' else route.peer_chat_id
+    message_log(message.bot.get("db")).record(message, route.peer_chat_id, client_chat_id, route.event_id)
 
 
 async def prepare_vars(message: types.Message, state: FSMContext):
-    state_data = await state.get_data()
-    keyboard = InlineKeyboardMarkup()
-    if message.bot.data["bot"] == 'CLIENT_BOT':
-        event_id = state_data['chat_data'].message.caption.split(f'\n')[0]
-        event_id = int(event_id[event_id.find(':') + 1:])
-        item = await db_get_item_by_id(message.bot.get("db"), event_id)
-
-        url = f"{config.CLIENT_BOT_URL}looktoid_{str(item.event_id)}"
-        keyboard.row(
-            InlineKeyboardButton(
-                text="Ответить",
-                callback_data=f"answeruser_{message.chat.id}"
-            ),
-            InlineKeyboardButton(
-                text="Посмотреть событие",
-                url=url
-            )
-        )
-        text_ = f"Сообщение:{item.event_name},\n" + \
-                f"{message.from_user.full_name}: "
-        text_ += f"{message.text}" if message.text else ""
-        tmp_var_chat_id = item.user_id
-    else:
-        event_name = state_data['chat_data'].message.html_text.split(f'\n')[0]
-        event_name = event_name[event_name.find(':') + 1:]
-        keyboard.row(
-            InlineKeyboardButton(
-                text="Ответить",
-                callback_data="connect_owner"
-            ),
-            InlineKeyboardButton(
-                text="Посмотреть событие",
-                callback_data="Посмотреть событие"
-            )
-        )
-        text_ = f"Сообщение от владельца события {event_name}\n"
-        text_ += f"{message.text}" if message.text else ""
-        tmp_var_chat_id = state_data['chat_data'].data.split(f'_')[1]
-
-    destination_dir = config.FILE_DIR[message.bot.data["bot"]]
-    return text_, tmp_var_chat_id, keyboard, destination_dir
+    route = await get_route(message, state)
+    log_message(message, route)
+    # texts collected before this message go first
+    flush_text(message, route.peer_chat_id)
+    text_ = route.text_prefix
+    text_ += f"{message.text}" if message.text else ""
+    return text_, route.peer_chat_id, route.keyboard
 
 
 async def forward_text(message: types.Message, state: FSMContext):
     """
     Forwards text message to pair bot.
+    With config.RELAY_COALESCE_WINDOW texts sent in a row are relayed as one message.
     """
-    text_, chat_id_, keyboard, _ = await prepare_vars(message, state)
-    with message.bot.with_token(message.bot.data["send_to_bot_token"]):
-        await message.bot.send_message(
-            chat_id=chat_id_,
-            text=text_,
-            reply_markup=keyboard
-        )
+    if coalescing():
+        route = await get_route(message, state)
+        log_message(message, route)
+        collect_text(message, route.peer_chat_id, route.text_prefix, message.text, route.keyboard)
+        return
+    text_, chat_id_, keyboard = await prepare_vars(message, state)
+    pair_scheduler(message.bot).submit(
+        'send_message',
+        chat_id_,
+        PRIORITY_RELAY,
+        text=text_,
+        reply_markup=keyboard
+    )
 
 
 async def forward_sticker(message: types.Message, state: FSMContext):
     """
     Forwards media message to pair bot.
     """
-    text_, chat_id_, keyboard, _ = await prepare_vars(message, state)
-    with message.bot.with_token(message.bot.data["send_to_bot_token"]):
-        await message.bot.send_sticker(
-            chat_id=chat_id_,
-            sticker=message.sticker.file_id,
-            reply_markup=keyboard
-        )
+    text_, chat_id_, keyboard = await prepare_vars(message, state)
+    pair_scheduler(message.bot).submit(
+        'send_sticker',
+        chat_id_,
+        PRIORITY_RELAY,
+        sticker=message.sticker.file_id,
+        reply_markup=keyboard
+    )
 
 
 async def forward_video_note(message: types.Message, state: FSMContext):
     """
     Forwards media message to pair bot.
     """
-    text_, chat_id_, keyboard, _ = await prepare_vars(message, state)
-    file_ = await message.video_note.download()
-    with message.bot.with_token(message.bot.data["send_to_bot_token"]):
-        file_ = types.InputFile(os.path.abspath(os.curdir)+'/'+file_.name)
-        await message.bot.send_video_note(
-            chat_id=chat_id_,
-            video_note=file_,
-            reply_markup=keyboard
-        )
+    text_, chat_id_, keyboard = await prepare_vars(message, state)
+    await relay_media(message, chat_id_, reply_markup=keyboard)
 
 
 async def forward_media_message(message: types.Message, state: FSMContext):
@@ -169,34 +172,28 @@ async def forward_media_message(message: types.Message, state: FSMContext):
     Forwards media message to pair bot.
     work with next content types:
     voice, animation, video, document, audio, photo
+    Elements of an album are relayed together as one album.
     """
-    text_, chat_id_, keyboard, destination_dir = await prepare_vars(message, state)
-    if message.content_type == 'photo':
-        file_ = await getattr(message, message.content_type)[-1].download(destination_dir=destination_dir)
-    else:
-        file_ = await getattr(message, message.content_type).download(destination_dir=destination_dir)
-    with message.bot.with_token(message.bot.data["send_to_bot_token"]):
-        file_ = types.InputFile(os.path.abspath(os.curdir)+'/'+file_.name)
-        await getattr(message.bot, 'send_'+message.content_type)(
-            chat_id_,
-            file_,
-            caption=text_,
-            reply_markup=keyboard
-        )
+    text_, chat_id_, keyboard = await prepare_vars(message, state)
+    if message.media_group_id:
+        collect_album(message, chat_id_, text_, keyboard)
+        return
+    await relay_media(message, chat_id_, caption=text_, reply_markup=keyboard)
 
 
 async def forward_location(message: types.Message, state: FSMContext):
     """
     Forwards location to pair bot.
     """
-    text_, chat_id_, keyboard, _ = await prepare_vars(message, state)
-    with message.bot.with_token(message.bot.data["send_to_bot_token"]):
-        await message.bot.send_location(
-            chat_id=chat_id_,
-            longitude=message.location.longitude,
-            latitude=message.location.latitude,
-            reply_markup=keyboard
-        )
+    text_, chat_id_, keyboard = await prepare_vars(message, state)
+    pair_scheduler(message.bot).submit(
+        'send_location',
+        chat_id_,
+        PRIORITY_RELAY,
+        longitude=message.location.longitude,
+        latitude=message.location.latitude,
+        reply_markup=keyboard
+    )
 
 
 async def show_event(message: types.Message, state: FSMContext):
@@ -210,17 +207,17 @@ async def show_event(message: types.Message, state: FSMContext):
     @param message: aiogram.types.Massage
     @param offset: int
     """
-    state_data = await state.get_data()
-    event_id = state_data['chat_data'].message.caption.split(f'\n')[0]
-    event_id = int(event_id[event_id.find(':') + 1:])
-
-    item = await db_get_item_by_id(message.bot.get("db"), event_id)
-    caption = f'Событие#:{item.event_id}\n' + \
-              f'Заголовок: {item.event_header}\n' + \
-              f'Описание: {item.event_description}\n'
+    route = await get_route(message, state)
+    try:
+        item = await db_get_item_by_id(message.bot.get("db"), route.event_id)
+    except NoResultFound:
+        answer(message, "Событие удалено.")
+        return
+    caption = render.render_event(item).caption
 
-    await message.bot.send_photo(
-        chat_id=message.chat.id,
+    own_scheduler(message.bot).submit(
+        'send_photo',
+        message.chat.id,
         photo=item.event_media,
         caption=caption,
         parse_mode="HTML",
@@ -236,6 +233,7 @@ def register_handlers_connect(dp: Dispatcher):
     )
     dp.register_callback_query_handler(connect_user, lambda c: c.data.split('_')[0] == 'answeruser', state='*')
     dp.register_callback_query_handler(connect_user, lambda c: c.data == 'connect_owner', state='*')
+    dp.register_callback_query_handler(connect_user, keyb.event_callback.filter(action='connect'), state='*')
 
     dp.register_message_handler(show_event, lambda message: message.text == "Посмотреть событие", state=Form.chat_data)
     dp.register_message_handler(forward_text, content_types=ContentType.TEXT, state=Form.chat_data)
@@ -0,0 +1,111 @@
+"""
+The module shows the history of a conversation relayed between the bots.
+A conversation is an event and the client bot user who wrote about it,
+both sides see it with the "История" button of the chat keyboard.
+"""
+import html
+
+from aiogram import types, Dispatcher
+from aiogram.dispatcher import FSMContext
+from sqlalchemy.exc import NoResultFound
+
+from db.db_commands import db_get_conversation, db_get_item_by_id
+from handlers.fsm_connect import Form
+import handlers.keyboards as keyb
+from services.message_log import message_log
+from services.outbound import answer
+from services.routing import get_route
+
+HISTORY_PAGE = 20  # number of messages on one page
+HISTORY_TEXT_LIMIT = 150  # characters of one message shown
+
+CONTENT_LABELS = {
+    'photo': 'фото',
+    'video': 'видео',
+    'voice': 'голосовое',
+    'audio': 'аудио',
+    'document': 'документ',
+    'animation': 'анимация',
+    'sticker': 'стикер',
+    'video_note': 'видеосообщение',
+    'location': 'геопозиция',
+}
+
+
+def history_line(row, viewer_chat_id: int) -> str:
+    """
+    Return one message of the history as an HTML line.
+
+    @param row: MessageLogTable
+    @param viewer_chat_id: int chat the history is shown in
+
+    @rtype: str
+    """
+    who = "Вы" if row.sender_chat_id == viewer_chat_id else "Собеседник"
+    text = row.text or ""
+    if len(text) > HISTORY_TEXT_LIMIT:
+        text = text[:HISTORY_TEXT_LIMIT] + "…"
+    label = CONTENT_LABELS.get(row.content_type)
+    body = (f"[{label}] " if label else "") + html.escape(text)
+    return f"{row.created:%d.%m %H:%M} <b>{who}</b>: {body}"
+
+
+async def history_show_page(message: types.Message, viewer_chat_id: int, event_id: int, client_chat_id: int,
+                            before_id):
+    """
+    Send a page of the conversation preceding before_id, oldest message first,
+    and the button of the earlier messages if there are more.
+
+    @param message: aiogram.types.Massage
+    @param viewer_chat_id: int
+    @param event_id: int
+    @param client_chat_id: int chat of the client bot user
+    @param before_id: int message_id of the oldest shown message or None for the latest messages
+    """
+    db = message.bot.get("db")
+    # the messages relayed just before are still in the write buffer
+    await message_log(db).flush()
+    rows = await db_get_conversation(db, event_id, client_chat_id, before_id, HISTORY_PAGE + 1)
+    page = rows[:HISTORY_PAGE]
+    if not page:
+        answer(message, "История пуста." if before_id is None else "Более ранних сообщений нет.")
+        return
+    keyboard = None
+    if len(rows) > HISTORY_PAGE:
+        keyboard = keyb.keyboard_history_more(event_id, client_chat_id, page[-1].message_id)
+    # created is stored in UTC
+    lines = ["<i>Время UTC</i>"] + [history_line(row, viewer_chat_id) for row in reversed(page)]
+    answer(message, "\n".join(lines), reply_markup=keyboard)
+
+
+async def history_start(message: types.Message, state: FSMContext):
+    """Show the latest messages of the current chat"""
+    route = await get_route(message, state)
+    client_chat_id = message.chat.id if message.bot.data["bot"] == 'CLIENT_BOT' else route.peer_chat_id
+    await history_show_page(message, message.chat.id, route.event_id, client_chat_id, None)
+
+
+async def history_page_handler(query: types.CallbackQuery, callback_data: dict):
+    """
+    Show the earlier messages after the pressed "Раньше"-button.
+    Only the client bot user and the event owner may read the conversation.
+    """
+    await query.answer()
+    event_id = int(callback_data.get("event_id"))
+    client_chat_id = int(callback_data.get("client"))
+    viewer_chat_id = query.message.chat.id
+    if viewer_chat_id != client_chat_id:
+        try:
+            item = await db_get_item_by_id(query.bot.get("db"), event_id)
+        except NoResultFound:
+            return
+        if item.user_id != viewer_chat_id:
+            return
+    await history_show_page(query.message, viewer_chat_id, event_id, client_chat_id,
+                            int(callback_data.get("before")))
+
+
+def register_history_handlers(dp: Dispatcher):
+    """register handlers, before the relay handlers of the chat"""
+    dp.register_message_handler(history_start, lambda message: message.text == "История", state=Form.chat_data)
+    dp.register_callback_query_handler(history_page_handler, keyb.history_callback.filter(), state='*')
@@ -4,15 +4,20 @@ This module describes most of the keyboards
 from aiogram import types
 from aiogram.utils.callback_data import CallbackData
 
-KEYBOARD_MAIN = ["Каталог", "Добавить событие"]
+KEYBOARD_MAIN = ["Каталог", "Поиск", "Добавить событие", "Мои события"]
 KEYBOARD_CANCEL = ["❌ Отменить операцию"]
 KEYBOARD_CONNECT = ["Связаться"]
 KEYBOARD_DELETE_EVENT = ["❌ Удалить событие"]
 KEYBOARD_ANSWER = ["Ответить"]
 KEYBOARD_LOOK_EVENT = ["Посмотреть событие"]
-KEYBOARD_CHAT = ["❌Выйти из чата", "Посмотреть событие"]
+KEYBOARD_CHAT = ["❌Выйти из чата", "Посмотреть событие", "История"]
 
-catalog_callback = CallbackData("catalog", "page", "to_page")
+catalog_callback = CallbackData("catalog", "last_id", "amount")
+CATALOG_MORE_AMOUNTS = (1, 5)
+event_callback = CallbackData("event", "action", "event_id")
+search_callback = CallbackData("search", "rank", "last_id")
+my_events_callback = CallbackData("my", "action", "value")
+history_callback = CallbackData("history", "event_id", "client", "before")
 
 
 def keyboard_reply_get(button_set) -> types.ReplyKeyboardMarkup:
@@ -71,30 +76,111 @@ def keyboard_catalog_delete_confirmation() -> types.InlineKeyboardMarkup:
     return keyboard
 
 
-def keyboard_catalog_show_more(pages: int, page: int) -> types.InlineKeyboardMarkup:
+def catalog_more_buttons(last_id: int, remaining: int) -> list:
     """
     return "more" - buttons ["+1","+5"] if are items to show
 
-    @param pages: int amount of items in catalog
-    @param page: int current page number
+    @param last_id: int event_id of the last shown item
+    @param remaining: int amount of items after last_id (at most max(CATALOG_MORE_AMOUNTS) is known)
+
+    @rtype: List[types.InlineKeyboardButton]
+    """
+    return [
+        types.InlineKeyboardButton(
+            text=f"+{amount}",
+            callback_data=catalog_callback.new(last_id=last_id, amount=amount)
+        )
+        for amount in CATALOG_MORE_AMOUNTS if remaining >= amount
+    ]
+
+
+def keyboard_catalog_show_more(last_id: int, remaining: int) -> types.InlineKeyboardMarkup:
+    """
+    return keyboard with "more" - buttons ["+1","+5"]
+
+    @param last_id: int event_id of the last shown item
+    @param remaining: int amount of items after last_id
 
     @rtype: types.InlineKeyboardMarkup
     """
     keyboard = types.InlineKeyboardMarkup()  # row_width=3
-    button_list = []
-    if pages > page + 1:
-        button_list.append(
+    keyboard.row(*catalog_more_buttons(last_id, remaining))
+    return keyboard
+
+
+def keyboard_search_more(rank: float, last_id: int) -> types.InlineKeyboardMarkup:
+    """
+    return keyboard with the button showing the next page of search results
+
+    @param rank: float rank of the last shown result
+    @param last_id: int event_id of the last shown result
+
+    @rtype: types.InlineKeyboardMarkup
+    """
+    keyboard = types.InlineKeyboardMarkup()
+    keyboard.row(
+        types.InlineKeyboardButton(
+            text="Ещё",
+            callback_data=search_callback.new(rank=repr(rank), last_id=last_id)
+        )
+    )
+    return keyboard
+
+
+def keyboard_my_events(items, selected, last_id: int, has_more: bool) -> types.InlineKeyboardMarkup:
+    """
+    Return keyboard of an owner's events page:
+    one toggle button per event, ['В начало','Ещё'] and 'Удалить выбранные' if any event is selected.
+
+    @param items: List[EventTable] events of the page
+    @param selected: collection of selected event_id
+    @param last_id: int event_id of the last event of the page
+    @param has_more: bool there are events after the page
+
+    @rtype: types.InlineKeyboardMarkup
+    """
+    keyboard = types.InlineKeyboardMarkup()
+    for item in items:
+        mark = "☑" if item.event_id in selected else "☐"
+        keyboard.row(
             types.InlineKeyboardButton(
-                text="+1",
-                callback_data=catalog_callback.new(page=page, to_page=page + 1)
+                text=f"{mark} #{item.event_id} {item.event_name}",
+                callback_data=my_events_callback.new(action="toggle", value=item.event_id)
             )
         )
-    if pages > page + 5:
+    button_list = [
+        types.InlineKeyboardButton(text="В начало", callback_data=my_events_callback.new(action="page", value=0))
+    ]
+    if has_more:
         button_list.append(
+            types.InlineKeyboardButton(text="Ещё", callback_data=my_events_callback.new(action="page", value=last_id))
+        )
+    keyboard.row(*button_list)
+    if selected:
+        keyboard.row(
             types.InlineKeyboardButton(
-                text="+5",
-                callback_data=catalog_callback.new(page=page, to_page=page + 5)
+                text=f"❌ Удалить выбранные ({len(selected)})",
+                callback_data=my_events_callback.new(action="delete", value=0)
             )
         )
-    keyboard.row(*button_list)
+    return keyboard
+
+
+def keyboard_history_more(event_id: int, client_chat_id: int, before_id: int) -> types.InlineKeyboardMarkup:
+    """
+    return keyboard with the button showing earlier messages of the conversation
+
+    @param event_id: int
+    @param client_chat_id: int chat of the client bot user
+    @param before_id: int message_id of the oldest shown message
+
+    @rtype: types.InlineKeyboardMarkup
+    """
+    keyboard = types.InlineKeyboardMarkup()
+    keyboard.row(
+        types.InlineKeyboardButton(
+            text="Раньше",
+            callback_data=history_callback.new(event_id=event_id, client=client_chat_id, before=before_id)
+        )
+    )
     return keyboard
@@ -0,0 +1,86 @@
+"""
+The module provides the view of the events of their owner with bulk delete.
+The page start and the selected events are kept in FSM data.
+"""
+from aiogram import types, Dispatcher
+from aiogram.dispatcher import FSMContext
+
+from db.db_commands import db_get_user_events, db_delete_user_events
+import handlers.keyboards as keyb
+from services.outbound import answer, own_scheduler
+
+MY_EVENTS_PAGE = 10  # number of events on one page
+
+
+async def my_events_render(message: types.Message, user_id: int, state: FSMContext, last_seen_id: int):
+    """
+    Return text and keyboard of the owner's events page following last_seen_id.
+
+    @param message: aiogram.types.Massage
+    @param user_id: int owner
+    @param state: FSMContext
+    @param last_seen_id: int
+
+    @rtype: (str, types.InlineKeyboardMarkup)
+    """
+    items = await db_get_user_events(message.bot.get("db"), user_id, last_seen_id, MY_EVENTS_PAGE + 1)
+    page = items[:MY_EVENTS_PAGE]
+    data = await state.get_data()
+    selected = set(data.get('my_events_selected', []))
+    await state.update_data(my_events_page=last_seen_id)
+    if not page:
+        return 'У вас нет событий.', None
+    text = 'Ваши события, отметьте лишние и удалите их разом:'
+    keyboard = keyb.keyboard_my_events(page, selected, page[-1].event_id, len(items) > MY_EVENTS_PAGE)
+    return text, keyboard
+
+
+async def my_events_index(message: types.Message, state: FSMContext):
+    """Show the first page of the owner's events"""
+    await state.update_data(my_events_selected=[])
+    text, keyboard = await my_events_render(message, message.from_user.id, state, 0)
+    answer(message, text, reply_markup=keyboard)
+
+
+async def my_events_edit(query: types.CallbackQuery, state: FSMContext, last_seen_id: int):
+    text, keyboard = await my_events_render(query.message, query.from_user.id, state, last_seen_id)
+    own_scheduler(query.bot).submit(
+        'edit_message_text', query.message.chat.id,
+        text=text, message_id=query.message.message_id, reply_markup=keyboard
+    )
+
+
+async def my_events_page_handler(query: types.CallbackQuery, callback_data: dict, state: FSMContext):
+    """Show the page following the event_id of the pressed button, the selection is kept"""
+    await my_events_edit(query, state, int(callback_data.get("value")))
+    await query.answer()
+
+
+async def my_events_toggle_handler(query: types.CallbackQuery, callback_data: dict, state: FSMContext):
+    """Select or unselect the event of the pressed button"""
+    event_id = int(callback_data.get("value"))
+    data = await state.get_data()
+    selected = set(data.get('my_events_selected', []))
+    selected.symmetric_difference_update([event_id])
+    await state.update_data(my_events_selected=sorted(selected))
+    await my_events_edit(query, state, data.get('my_events_page', 0))
+    await query.answer()
+
+
+async def my_events_delete_handler(query: types.CallbackQuery, state: FSMContext):
+    """Delete all selected events with one query and show the first page again"""
+    data = await state.get_data()
+    deleted = await db_delete_user_events(
+        query.bot.get("db"), query.from_user.id, data.get('my_events_selected', [])
+    )
+    await state.update_data(my_events_selected=[])
+    await my_events_edit(query, state, 0)
+    await query.answer(f'Удалено событий: {deleted}')
+
+
+def register_my_events_handlers(dp: Dispatcher):
+    """register handlers"""
+    dp.register_message_handler(my_events_index, lambda message: message.text == "Мои события")
+    dp.register_callback_query_handler(my_events_page_handler, keyb.my_events_callback.filter(action='page'))
+    dp.register_callback_query_handler(my_events_toggle_handler, keyb.my_events_callback.filter(action='toggle'))
+    dp.register_callback_query_handler(my_events_delete_handler, keyb.my_events_callback.filter(action='delete'))
@@ -0,0 +1,88 @@
+"""
+Precompiled captions and keyboards.
+Static keyboards are serialized to JSON once and shared by all sends,
+aiogram passes a str reply_markup to the Bot API as is.
+Caption and compact keyboard buttons of an event are rendered once and kept in
+the event cache under ('render', event_id), so they are dropped together with the event.
+"""
+import json
+import typing
+
+from aiogram import types
+
+from db.cache import event_cache
+from db.models import EventTable
+import handlers.keyboards as keyb
+
+
+def serialize(markup) -> str:
+    """Return reply_markup JSON of the keyboard"""
+    return json.dumps(markup.to_python(), ensure_ascii=False, separators=(',', ':'))
+
+
+REPLY_MAIN = serialize(keyb.keyboard_reply_get(keyb.KEYBOARD_MAIN))
+REPLY_CANCEL = serialize(keyb.keyboard_reply_get(keyb.KEYBOARD_CANCEL))
+REPLY_CHAT = serialize(keyb.keyboard_reply_get(keyb.KEYBOARD_CHAT))
+CATALOG_OWNER = serialize(keyb.keyboard_catalog_get(is_owner=True))
+CATALOG_OTHER = serialize(keyb.keyboard_catalog_get(is_owner=False))
+DELETE_CONFIRMATION = serialize(keyb.keyboard_catalog_delete_confirmation())
+
+
+class RenderedEvent(typing.NamedTuple):
+    caption: str
+    connect_button: dict  # buttons of the compact media group keyboard
+    delete_button: dict
+
+
+def render_event(item: EventTable) -> RenderedEvent:
+    """
+    Return caption and buttons of the event, rendered on the first call.
+
+    @param item: EventTable
+
+    @rtype: RenderedEvent
+    """
+    rendered = event_cache.get(('render', item.event_id))
+    if rendered is not None:
+        return rendered
+
+    caption = f'Событие#:{item.event_id}\n' + \
+              f'Заголовок: {item.event_header}\n' + \
+              f'Описание: {item.event_description}\n'
+    rendered = RenderedEvent(
+        caption,
+        types.InlineKeyboardButton(
+            text=f"Связаться #{item.event_id}",
+            callback_data=keyb.event_callback.new(action="connect", event_id=item.event_id)
+        ).to_python(),
+        types.InlineKeyboardButton(
+            text=f"❌ Удалить #{item.event_id}",
+            callback_data=keyb.event_callback.new(action="delete", event_id=item.event_id)
+        ).to_python(),
+    )
+    event_cache.set(('render', item.event_id), rendered)
+    return rendered
+
+
+def catalog_group_markup(items: typing.List[EventTable], chat_id: int, remaining: int) -> str:
+    """
+    Return compact keyboard JSON for a catalog page sent as media group:
+    one row ['Связаться #id','Удалить #id'] per event and "more" - buttons.
+
+    @param items: List[EventTable]
+    @param chat_id: int chat the page is sent to, the delete button is shown to the owner only
+    @param remaining: int amount of items after the page
+
+    @rtype: str
+    """
+    rows = []
+    for item in items:
+        rendered = render_event(item)
+        if item.user_id == chat_id:
+            rows.append([rendered.connect_button, rendered.delete_button])
+        else:
+            rows.append([rendered.connect_button])
+    more_buttons = keyb.catalog_more_buttons(items[-1].event_id, remaining) if items else []
+    if more_buttons:
+        rows.append([button.to_python() for button in more_buttons])
+    return json.dumps({'inline_keyboard': rows}, ensure_ascii=False, separators=(',', ':'))
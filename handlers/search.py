@@ -0,0 +1,79 @@
+"""
+The module provides full-text search over the event catalog
+"""
+from aiogram import types, Dispatcher
+from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.filters.state import State, StatesGroup
+
+from db.db_commands import db_search_events
+from handlers.catalog import catalog_show_event
+import handlers.keyboards as keyb
+import handlers.render as render
+from services.outbound import answer, own_scheduler, PRIORITY_CATALOG
+
+SEARCH_PAGE = 5  # number of results on one page
+
+
+class SearchForm(StatesGroup):
+    query = State()
+
+
+async def search_start(message: types.Message):
+    """Ask for the search query"""
+    await SearchForm.query.set()
+    answer(message, "Что найти?", reply_markup=render.REPLY_CANCEL)
+
+
+async def search_query_handler(message: types.Message, state: FSMContext):
+    """
+    Save the query to FSM data for the next pages and show the best results.
+    """
+    await state.update_data(search_query=message.text)
+    await state.reset_state(with_data=False)
+    answer(message, "Результаты поиска:", reply_markup=render.REPLY_MAIN)
+    if not await search_show_page(message, message.text, None):
+        answer(message, "Ничего не найдено.")
+
+
+async def search_page_handler(query: types.CallbackQuery, callback_data: dict, state: FSMContext):
+    """
+    Show the next page of results of the last query after the pressed "more"-button
+    """
+    search_query = (await state.get_data()).get('search_query')
+    if not search_query:
+        answer(query.message, "Поиск устарел, начните новый.")
+        return
+    cursor = (float(callback_data.get("rank")), int(callback_data.get("last_id")))
+    if not await search_show_page(query.message, search_query, cursor):
+        answer(query.message, "Больше ничего не найдено.")
+
+
+async def search_show_page(message: types.Message, search_query: str, cursor) -> bool:
+    """
+    Send a page of results following the cursor and the "more"-button if there are more results.
+
+    @param message: aiogram.types.Massage
+    @param search_query: str
+    @param cursor: (rank, event_id) of the last shown result or None
+
+    @rtype: bool False if there was nothing to show
+    """
+    results = await db_search_events(message.bot.get("db"), search_query, cursor, SEARCH_PAGE + 1)
+    page = results[:SEARCH_PAGE]
+    for item, _ in page:
+        await catalog_show_event(message, item)
+
+    if len(results) > SEARCH_PAGE:
+        last_item, last_rank = page[-1]
+        own_scheduler(message.bot).submit(
+            'send_message', message.chat.id, PRIORITY_CATALOG, text='Показать больше',
+            reply_markup=keyb.keyboard_search_more(last_rank, last_item.event_id)
+        )
+    return bool(page)
+
+
+def register_search_handlers(dp: Dispatcher):
+    """register handlers"""
+    dp.register_message_handler(search_start, lambda message: message.text == "Поиск")
+    dp.register_message_handler(search_query_handler, state=SearchForm.query)
+    dp.register_callback_query_handler(search_page_handler, keyb.search_callback.filter())
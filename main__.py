@@ -7,77 +7,145 @@ receives messages from the client bot and organizes the sending
 of responses.
 """
 
-import logging.config
+import logging
 
 import asyncio
 from aiogram import Bot, Dispatcher
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from sqlalchemy.orm import sessionmaker
 
 import config
-from db.base import Base
+from db.engine import create_db_session
 from handlers.commands import register_commands
 from handlers.catalog import register_catalog_handlers
 from handlers.fsm_connect import register_handlers_connect
 from handlers.fsm_add_event import register_handlers_add_event
+from handlers.history import register_history_handlers
+from handlers.my_events import register_my_events_handlers
+from handlers.search import register_search_handlers
+from services.album import close_albums
+from services.chat_queue import setup_chat_queue
+from services.coalesce import close_batches
+from services.expiry import start_expiry_sweeper
+from services.logs import setup_logging
+from services.media_store import close_media_store
+from services.message_log import close_message_log
+from services.metrics import setup_metrics, start_metrics_server
+from services.outbound import close_schedulers
+from storage import create_storage
+from webhook import run_webhook
+from workers import run_supervisor
+
+
+setup_logging()
+logger = logging.getLogger(__name__)
 
 
-logging.config.fileConfig(fname=r'logger.ini', disable_existing_loggers=False)
-logger = logging.getLogger(__name__)
+def create_bot(token: str) -> Bot:
+    """
+    Return bot talking to config.BOT_API_SERVER,
+    a local Bot API server or a test stand-in, or to api.telegram.org by default.
+    """
+    base = getattr(config, 'BOT_API_SERVER', None)
+    server = TelegramAPIServer.from_base(base) if base else TELEGRAM_PRODUCTION
+    return Bot(token, parse_mode="HTML", server=server)
+
 
-async def start_service_bot():
-    bot = Bot(config.SERVICE_TOKEN, parse_mode="HTML")
+def create_service_dispatcher(async_sessionmaker: sessionmaker) -> Dispatcher:
+    bot = create_bot(config.SERVICE_TOKEN)
+    bot["db"] = async_sessionmaker
     bot["bot"] = 'SERVICE_BOT'
+    bot["token"] = config.SERVICE_TOKEN
+    bot["send_to_bot"] = 'CLIENT_BOT'
     bot["send_to_bot_token"] = config.CLIENT_TOKEN
-    dp = Dispatcher(bot, storage=MemoryStorage())
+    dp = Dispatcher(bot, storage=create_storage(bot["bot"], async_sessionmaker))
+    setup_metrics(dp)
+    setup_chat_queue(dp)
 
     register_commands(dp)
+    register_history_handlers(dp)
     register_handlers_connect(dp)
-
-    try:
-        await dp.start_polling(dp)
-    finally:
-        await dp.storage.close()
-        await dp.storage.wait_closed()
-        await bot.session.close()
+    return dp
 
 
-async def start_client_bot():
+def create_client_dispatcher(async_sessionmaker: sessionmaker) -> Dispatcher:
     """
-    Since the work is a test one, the SQLite database and Memory storage are selected.
-    In real conditions, other databases should be used, for example MySQL and Redis.
+    FSM storage is selected by config.FSM_STORAGE,
+    the Memory storage loses all conversations on restart.
     """
-    engine = create_async_engine(
-        "sqlite+aiosqlite:///./test.db",
-        future=True
-    )
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
-    async_sessionmaker = sessionmaker(
-        engine, expire_on_commit=False, class_=AsyncSession
-    )
-    bot = Bot(config.CLIENT_TOKEN, parse_mode="HTML")
+    bot = create_bot(config.CLIENT_TOKEN)
     bot["db"] = async_sessionmaker
     bot["bot"] = 'CLIENT_BOT'
+    bot["token"] = config.CLIENT_TOKEN
+    bot["send_to_bot"] = 'SERVICE_BOT'
     bot["send_to_bot_token"] = config.SERVICE_TOKEN
-    dp = Dispatcher(bot, storage=MemoryStorage())
+    dp = Dispatcher(bot, storage=create_storage(bot["bot"], async_sessionmaker))
+    setup_metrics(dp)
+    setup_chat_queue(dp)
 
     register_commands(dp)
     register_catalog_handlers(dp)
     register_handlers_add_event(dp)
+    register_search_handlers(dp)
+    register_my_events_handlers(dp)
+    register_history_handlers(dp)
     register_handlers_connect(dp)
+    return dp
+
+
+async def close_dispatcher(dp: Dispatcher):
+    await close_albums()
+    close_batches()
+    await close_schedulers()
+    await close_media_store()
+    await close_message_log()
+    await dp.storage.close()
+    await dp.storage.wait_closed()
+    session = await dp.bot.get_session()
+    await session.close()
 
+
+async def start_polling(dp: Dispatcher):
     try:
-        await dp.start_polling(dp)
+        await dp.start_polling()
     finally:
-        await dp.storage.close()
-        await dp.storage.wait_closed()
-        await bot.session.close()
+        await close_dispatcher(dp)
+
+
+async def start_service_bot(async_sessionmaker: sessionmaker):
+    await start_polling(create_service_dispatcher(async_sessionmaker))
+
+
+async def start_client_bot(async_sessionmaker: sessionmaker):
+    await start_polling(create_client_dispatcher(async_sessionmaker))
 
 
 async def main():
-    await asyncio.gather(start_service_bot(), start_client_bot())
+    """
+    config.RUN_MODE selects long polling ('polling') or one webhook server for both bots ('webhook'),
+    with config.WORKERS > 0 the updates are handled by a pool of worker processes.
+    """
+    if getattr(config, 'WORKERS', 0) > 0:
+        await run_supervisor(config.WORKERS)
+        return
+
+    async_sessionmaker = await create_db_session()
+    sweeper = start_expiry_sweeper(async_sessionmaker)
+    metrics = await start_metrics_server() if getattr(config, 'METRICS_PORT', None) else None
+    try:
+        if getattr(config, 'RUN_MODE', 'polling') == 'webhook':
+            dispatchers = [create_client_dispatcher(async_sessionmaker), create_service_dispatcher(async_sessionmaker)]
+            try:
+                await run_webhook(dispatchers)
+            finally:
+                for dp in dispatchers:
+                    await close_dispatcher(dp)
+        else:
+            await asyncio.gather(start_service_bot(async_sessionmaker), start_client_bot(async_sessionmaker))
+    finally:
+        sweeper.cancel()
+        if metrics is not None:
+            await metrics.cleanup()
 
 if __name__ == '__main__':
     try:
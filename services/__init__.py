@@ -0,0 +1,3 @@
+"""
+Infrastructure shared by the bot handlers
+"""
@@ -0,0 +1,143 @@
+"""
+Relay of albums between the client and service bots.
+Telegram delivers every element of an album as a separate message with the same
+media_group_id. The elements are collected for config.RELAY_ALBUM_WINDOW seconds
+after the last one arrives, downloaded in parallel and sent with one
+send_media_group followed by one message with the keyboard of the chat.
+"""
+import asyncio
+import logging
+import typing
+from contextlib import AsyncExitStack
+
+from aiogram import types
+from aiogram.utils.exceptions import BadRequest
+
+import config
+from db.db_commands import db_get_file_id, db_save_file_id
+from services.outbound import pair_scheduler, PRIORITY_RELAY
+from services.relay import media_of, relay_file
+
+logger = logging.getLogger(__name__)
+
+ALBUM_WINDOW = getattr(config, 'RELAY_ALBUM_WINDOW', 1.0)  # seconds
+
+INPUT_MEDIA = {
+    'photo': types.InputMediaPhoto,
+    'video': types.InputMediaVideo,
+    'document': types.InputMediaDocument,
+    'audio': types.InputMediaAudio,
+}
+
+
+class Album:
+    __slots__ = ('chat_id', 'text', 'keyboard', 'messages', 'timer')
+
+    def __init__(self, chat_id, text: str, keyboard):
+        self.chat_id = chat_id
+        self.text = text
+        self.keyboard = keyboard
+        self.messages = []
+        self.timer = None
+
+
+_albums = {}
+_relaying = set()
+
+
+def collect_album(message: types.Message, chat_id, text: str, keyboard):
+    """
+    Add the album element to its album, the album is relayed when no element came for ALBUM_WINDOW.
+
+    @param message: aiogram.types.Message with media_group_id
+    @param chat_id: chat of the pair bot
+    @param text: str caption prefix of the chat
+    @param keyboard: keyboard of the chat, sent once after the album
+    """
+    key = (message.bot.data["bot"], message.chat.id, message.media_group_id)
+    album = _albums.get(key)
+    if album is None:
+        album = _albums[key] = Album(chat_id, text, keyboard)
+    else:
+        album.timer.cancel()
+    album.messages.append(message)
+    album.timer = asyncio.get_running_loop().call_later(ALBUM_WINDOW, _flush, key)
+
+
+def _flush(key):
+    album = _albums.pop(key)
+    task = asyncio.create_task(relay_album(album))
+    _relaying.add(task)
+    task.add_done_callback(_relay_done)
+
+
+def _relay_done(task: asyncio.Task):
+    _relaying.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error('album relay failed', exc_info=task.exception())
+
+
+async def _input_media(stack: AsyncExitStack, message: types.Message, file_id: typing.Optional[str], caption):
+    if file_id is None:
+        file_id = await stack.enter_async_context(relay_file(media_of(message)))
+    return INPUT_MEDIA[message.content_type](media=file_id, caption=caption)
+
+
+async def _send_album(album: Album, messages: typing.List[types.Message], file_ids: list) -> list:
+    captions = [message.caption for message in messages]
+    captions[0] = album.text + (captions[0] or '')
+    async with AsyncExitStack() as stack:
+        # downloads of the new files go in parallel
+        results = await asyncio.gather(
+            *(_input_media(stack, message, file_id, caption)
+              for message, file_id, caption in zip(messages, file_ids, captions)),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return await pair_scheduler(messages[0].bot).submit(
+            'send_media_group', album.chat_id, PRIORITY_RELAY, media=types.MediaGroup(results)
+        )
+
+
+async def relay_album(album: Album):
+    """
+    Send the collected album through the pair bot with one send_media_group.
+    Elements already relayed go by file_id, new ones are uploaded and their file_id remembered.
+
+    @param album: Album
+    """
+    messages = sorted(album.messages, key=lambda message: message.message_id)
+    bot = messages[0].bot
+    db = bot.get("db")
+    to_bot = bot.data["send_to_bot"]
+    medias = [media_of(message) for message in messages]
+
+    file_ids = await asyncio.gather(*(db_get_file_id(db, media.file_unique_id, to_bot) for media in medias))
+    try:
+        sent = await _send_album(album, messages, file_ids)
+    except BadRequest as err:
+        if not any(file_ids):
+            raise
+        logger.info('file_id of an album element is rejected by %s: %s', to_bot, err)
+        file_ids = [None] * len(messages)
+        sent = await _send_album(album, messages, file_ids)
+
+    await asyncio.gather(*(
+        db_save_file_id(db, media.file_unique_id, to_bot, media_of(sent_message).file_id)
+        for media, file_id, sent_message in zip(medias, file_ids, sent) if file_id is None
+    ))
+    pair_scheduler(bot).submit(
+        'send_message', album.chat_id, PRIORITY_RELAY,
+        text=album.text + f"альбом ({len(messages)})", reply_markup=album.keyboard
+    )
+
+
+async def close_albums():
+    """Relay the albums being collected at once and wait for all album relays"""
+    for key in list(_albums):
+        _albums[key].timer.cancel()
+        _flush(key)
+    if _relaying:
+        await asyncio.wait(list(_relaying))
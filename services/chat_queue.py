@@ -0,0 +1,187 @@
+"""
+Ordered update execution.
+aiogram handles updates concurrently, so two quick messages of one chat could run
+the same FSM step at once. ChatQueueMiddleware lets the updates of a chat run one
+after another in the order they came, while other chats go on in parallel, and caps
+the updates in progress of the process with config.UPDATE_MAX_IN_FLIGHT. Updates
+over config.UPDATE_MAX_QUEUED waiting updates, or over config.UPDATE_CHAT_MAX_QUEUED
+updates of one chat, are dropped.
+"""
+import asyncio
+import heapq
+import logging
+import typing
+
+from aiogram import Dispatcher, types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+import config
+from services.metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+UPDATE_MAX_IN_FLIGHT = getattr(config, 'UPDATE_MAX_IN_FLIGHT', 64)
+UPDATE_MAX_QUEUED = getattr(config, 'UPDATE_MAX_QUEUED', 1000)  # 0 never drops
+UPDATE_CHAT_MAX_QUEUED = getattr(config, 'UPDATE_CHAT_MAX_QUEUED', 20)  # 0 never drops
+REPORTED_CHATS = 10  # deepest chat queues exported as metrics
+
+
+class QueueFull(Exception):
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class _Chat:
+    __slots__ = ('lock', 'depth')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()  # FIFO, a free lock is taken without a context switch
+        self.depth = 0  # updates of the chat admitted and not finished
+
+
+class ChatQueue:
+    """
+    Admission of updates: one at a time per chat, max_in_flight in total.
+    Shared by the dispatchers of the process.
+    """
+
+    def __init__(self, max_in_flight: int, max_queued: int = 0, chat_max_queued: int = 0):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.chat_max_queued = chat_max_queued
+        self.queued = 0  # waiting for their chat or a slot
+        self.in_flight = 0
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._chats = {}  # key -> _Chat
+
+    async def acquire(self, key: typing.Optional[typing.Hashable]):
+        """
+        Wait for the turn of the update, QueueFull if it has to be dropped.
+
+        @param key: chat of the update or None for updates without a chat
+        """
+        if self.max_queued and self.queued >= self.max_queued:
+            raise QueueFull('queue')
+        chat = None
+        if key is not None:
+            chat = self._chats.get(key)
+            if chat is None:
+                chat = self._chats[key] = _Chat()
+            elif self.chat_max_queued and chat.depth > self.chat_max_queued:
+                raise QueueFull('chat')
+            chat.depth += 1
+
+        self.queued += 1
+        try:
+            if chat is not None:
+                await chat.lock.acquire()
+            try:
+                await self._slots.acquire()
+            except BaseException:
+                if chat is not None:
+                    chat.lock.release()
+                raise
+        except BaseException:
+            if chat is not None:
+                self._leave(key, chat)
+            raise
+        finally:
+            self.queued -= 1
+        self.in_flight += 1
+
+    def release(self, key: typing.Optional[typing.Hashable]):
+        """Finish the update admitted with acquire(key)"""
+        self.in_flight -= 1
+        self._slots.release()
+        if key is not None:
+            chat = self._chats[key]
+            chat.lock.release()
+            self._leave(key, chat)
+
+    def _leave(self, key, chat: _Chat):
+        chat.depth -= 1
+        if chat.depth == 0:
+            del self._chats[key]
+
+    def depths(self, limit: int = REPORTED_CHATS) -> typing.List[typing.Tuple[typing.Hashable, int]]:
+        """Return the deepest chat queues, (key, updates admitted and not finished)"""
+        return heapq.nlargest(limit, ((key, chat.depth) for key, chat in self._chats.items()),
+                              key=lambda item: item[1])
+
+    def stats(self) -> dict:
+        return {'in_flight': self.in_flight, 'queued': self.queued, 'chats': len(self._chats),
+                'max_chat_depth': max((chat.depth for chat in self._chats.values()), default=0)}
+
+
+def chat_key(update: types.Update) -> typing.Optional[int]:
+    """Return id of the chat the update belongs to, the user for updates without a chat"""
+    for name in ('message', 'edited_message', 'channel_post', 'edited_channel_post',
+                 'my_chat_member', 'chat_member', 'chat_join_request'):
+        obj = getattr(update, name)
+        if obj is not None:
+            return obj.chat.id
+    if update.callback_query is not None:
+        query = update.callback_query
+        return query.message.chat.id if query.message is not None else query.from_user.id
+    for name in ('inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query',
+                 'poll_answer'):
+        obj = getattr(update, name)
+        if obj is not None:
+            return obj.user.id if name == 'poll_answer' else obj.from_user.id
+    return None
+
+
+_queue: typing.Optional[ChatQueue] = None
+
+
+def chat_queue() -> ChatQueue:
+    """Return the queue of the process, both bots share it"""
+    global _queue
+    if _queue is None:
+        _queue = ChatQueue(UPDATE_MAX_IN_FLIGHT, UPDATE_MAX_QUEUED, UPDATE_CHAT_MAX_QUEUED)
+    return _queue
+
+
+SHED = Counter('bot_updates_dropped_total', 'Updates dropped by the chat queue', ('bot', 'reason'))
+IN_FLIGHT = Gauge('bot_updates_in_flight', 'Updates being handled', (),
+                  lambda: [((), _queue.in_flight)] if _queue is not None else [])
+QUEUED = Gauge('bot_updates_queued', 'Updates waiting for their chat or a free slot', (),
+               lambda: [((), _queue.queued)] if _queue is not None else [])
+CHAT_DEPTH = Gauge('bot_chat_queue_depth', 'Updates of the busiest chats admitted and not finished', ('bot', 'chat'),
+                   lambda: [(key, depth) for key, depth in _queue.depths()] if _queue is not None else [])
+
+
+class ChatQueueMiddleware(BaseMiddleware):
+    """
+    Holds the update in pre_process_update until its turn and lets the next one go
+    in post_process_update. Must be set up last so that no other middleware
+    cancels the update after it was admitted.
+    """
+
+    def __init__(self, bot_name: str, queue: ChatQueue):
+        super().__init__()
+        self.bot_name = bot_name
+        self.queue = queue
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        chat_id = chat_key(update)
+        key = (self.bot_name, chat_id) if chat_id is not None else None
+        try:
+            await self.queue.acquire(key)
+        except QueueFull as err:
+            SHED.inc(self.bot_name, err.reason)
+            logger.warning('update %s of chat %s dropped, %s is full: %s',
+                           update.update_id, chat_id, err.reason, self.queue.stats())
+            raise CancelHandler()
+        data['chat_queue_key'] = key
+
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        if 'chat_queue_key' in data:
+            self.queue.release(data.pop('chat_queue_key'))
+
+
+def setup_chat_queue(dp: Dispatcher):
+    """Run updates of the dispatcher in chat order, call after the other middlewares are set up"""
+    dp.middleware.setup(ChatQueueMiddleware(dp.bot["bot"], chat_queue()))
@@ -0,0 +1,93 @@
+"""
+Coalescing of relayed text messages.
+With config.RELAY_COALESCE_WINDOW > 0 the texts one user sends to one chat of the
+pair bot are collected for that many seconds after the first of them and relayed
+as one message with the keyboard of the chat. A batch goes at once when the next
+text would not fit in RELAY_COALESCE_MAX_CHARS or it has RELAY_COALESCE_MAX_MESSAGES
+texts, and before any other message of the user to the chat so the order is kept.
+"""
+import asyncio
+import typing
+
+from aiogram import types
+
+import config
+from services.outbound import pair_scheduler, PRIORITY_RELAY
+
+COALESCE_WINDOW = getattr(config, 'RELAY_COALESCE_WINDOW', 0)  # seconds, 0 relays every text at once
+COALESCE_MAX_CHARS = getattr(config, 'RELAY_COALESCE_MAX_CHARS', 4096)  # Telegram message limit
+COALESCE_MAX_MESSAGES = getattr(config, 'RELAY_COALESCE_MAX_MESSAGES', 20)
+
+
+class Batch:
+    __slots__ = ('bot', 'chat_id', 'prefix', 'keyboard', 'texts', 'size', 'timer')
+
+    def __init__(self, bot, chat_id, prefix: str, keyboard):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.prefix = prefix
+        self.keyboard = keyboard
+        self.texts = []
+        self.size = len(prefix)
+        self.timer = None
+
+
+_batches = {}
+
+
+def coalescing() -> bool:
+    return COALESCE_WINDOW > 0
+
+
+def collect_text(message: types.Message, chat_id, prefix: str, text: str, keyboard):
+    """
+    Add the text to the batch of the sender and the chat, the batch is relayed
+    COALESCE_WINDOW after its first text or when it is full.
+
+    @param message: aiogram.types.Message the text came with
+    @param chat_id: chat of the pair bot
+    @param prefix: str sender line of the chat, sent once per batch
+    @param text: str
+    @param keyboard: keyboard of the chat, sent with the batch
+    """
+    key = (message.bot.data["bot"], message.chat.id, chat_id)
+    batch = _batches.get(key)
+    if batch is not None and batch.size + 1 + len(text) > COALESCE_MAX_CHARS:
+        flush_text(message, chat_id)
+        batch = None
+    if batch is None:
+        batch = _batches[key] = Batch(message.bot, chat_id, prefix, keyboard)
+        batch.timer = asyncio.get_running_loop().call_later(COALESCE_WINDOW, _flush, key)
+    batch.texts.append(text)
+    batch.size += len(text) + 1
+    batch.keyboard = keyboard
+    if len(batch.texts) >= COALESCE_MAX_MESSAGES:
+        flush_text(message, chat_id)
+
+
+def flush_text(message: types.Message, chat_id):
+    """
+    Relay at once the texts of the message sender collected for the chat, if any.
+
+    @param message: aiogram.types.Message of the sender
+    @param chat_id: chat of the pair bot
+    """
+    key = (message.bot.data["bot"], message.chat.id, chat_id)
+    if key in _batches:
+        _batches[key].timer.cancel()
+        _flush(key)
+
+
+def _flush(key: typing.Tuple):
+    batch = _batches.pop(key)
+    pair_scheduler(batch.bot).submit(
+        'send_message', batch.chat_id, PRIORITY_RELAY,
+        text=batch.prefix + '\n'.join(batch.texts), reply_markup=batch.keyboard
+    )
+
+
+def close_batches():
+    """Relay the batches being collected at once"""
+    for key in list(_batches):
+        _batches[key].timer.cancel()
+        _flush(key)
@@ -0,0 +1,56 @@
+"""
+Background purge of expired events.
+Expired events are already hidden from the catalog by the query, the sweeper
+removes them from the table in small batches, one short transaction each,
+so it never holds the SQLite write lock for long.
+"""
+import asyncio
+import logging
+from datetime import datetime
+
+from sqlalchemy.orm import sessionmaker
+
+import config
+from db.db_commands import db_delete_expired
+
+logger = logging.getLogger(__name__)
+
+EXPIRY_SWEEP_INTERVAL = getattr(config, 'EXPIRY_SWEEP_INTERVAL', 600)  # seconds
+EXPIRY_BATCH_SIZE = getattr(config, 'EXPIRY_BATCH_SIZE', 500)
+BATCH_PAUSE = 0.05  # seconds between batches, lets the handlers write
+
+
+async def sweep_expired(db_session: sessionmaker, batch_size: int = EXPIRY_BATCH_SIZE) -> int:
+    """
+    Delete all events expired by now batch by batch.
+
+    @param db_session: sessionmaker
+    @param batch_size: int rows per transaction
+
+    @rtype: int number of deleted events
+    """
+    now = datetime.utcnow()
+    deleted = 0
+    while True:
+        event_ids = await db_delete_expired(db_session, now, batch_size)
+        deleted += len(event_ids)
+        if len(event_ids) < batch_size:
+            return deleted
+        await asyncio.sleep(BATCH_PAUSE)
+
+
+async def run_expiry_sweeper(db_session: sessionmaker, interval: float = EXPIRY_SWEEP_INTERVAL):
+    """Sweep expired events every interval seconds until cancelled"""
+    while True:
+        try:
+            deleted = await sweep_expired(db_session)
+            if deleted:
+                logger.info('expiry sweeper deleted %d events', deleted)
+        except Exception:
+            logger.exception('expiry sweep failed')
+        await asyncio.sleep(interval)
+
+
+def start_expiry_sweeper(db_session: sessionmaker) -> asyncio.Task:
+    """Start the sweeper in the background, one process of the bot system should run it"""
+    return asyncio.create_task(run_expiry_sweeper(db_session))
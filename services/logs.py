@@ -0,0 +1,129 @@
+"""
+Non-blocking logging.
+Records are put to an in-memory queue by a QueueHandler and written to the rotating
+log file by a listener thread, so the event loop never waits for the disk.
+Records carry update_id, chat_id and handler of the update being processed,
+DEBUG records can be sampled. config.LOG_MODE = 'ini' keeps the old logger.ini setup.
+"""
+import atexit
+import json
+import logging
+import logging.config
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import random
+
+from aiogram import types
+from aiogram.dispatcher.handler import current_handler
+
+import config
+
+LOG_MODE = getattr(config, 'LOG_MODE', 'queue')  # 'queue' or 'ini'
+LOG_FILE = getattr(config, 'LOG_FILE', 'Log_bot.log')
+LOG_LEVEL = getattr(config, 'LOG_LEVEL', 'INFO')
+LOG_FORMAT = getattr(config, 'LOG_FORMAT', 'text')  # 'text' or 'json' lines
+# {'max_bytes': ..., 'backup_count': ...} rotates by size, {'when': 'midnight', 'backup_count': ...} by time
+LOG_ROTATION = getattr(config, 'LOG_ROTATION', {'max_bytes': 10 * 1024 * 1024, 'backup_count': 5})
+LOG_DEBUG_SAMPLE_RATE = getattr(config, 'LOG_DEBUG_SAMPLE_RATE', 1.0)  # share of DEBUG records kept
+
+TEXT_FORMAT = '%(asctime)s,%(name)s[LINE:%(lineno)d] - %(message)s'
+
+_listener = None
+
+
+class ContextFilter(logging.Filter):
+    """
+    Adds update_id, chat_id and handler of the current update to the record
+    and drops a part of DEBUG records. Runs in the logging thread of the caller.
+    """
+
+    def __init__(self, debug_sample_rate: float = 1.0):
+        super().__init__()
+        self.debug_sample_rate = debug_sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno <= logging.DEBUG and self.debug_sample_rate < 1.0 \
+                and random.random() >= self.debug_sample_rate:
+            return False
+        update = types.Update.get_current(no_error=True)
+        chat = types.Chat.get_current(no_error=True)
+        handler = current_handler.get(None)
+        record.update_id = update.update_id if update is not None else None
+        record.chat_id = chat.id if chat is not None else None
+        record.handler = getattr(handler, '__name__', None)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'update_id': getattr(record, 'update_id', None),
+            'chat_id': getattr(record, 'chat_id', None),
+            'handler': getattr(record, 'handler', None),
+        }
+        if record.exc_info:
+            line['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            line['exc_info'] = record.exc_text
+        return json.dumps(line, ensure_ascii=False)
+
+
+def _file_name() -> str:
+    # worker processes write their own files, rotation of a shared file is not process safe
+    process = multiprocessing.current_process()
+    if process.name == 'MainProcess':
+        return LOG_FILE
+    base, ext = os.path.splitext(LOG_FILE)
+    return f'{base}.{process.name}{ext}'
+
+
+def _file_handler() -> logging.Handler:
+    if 'when' in LOG_ROTATION:
+        handler = logging.handlers.TimedRotatingFileHandler(
+            _file_name(), when=LOG_ROTATION['when'], backupCount=LOG_ROTATION.get('backup_count', 7),
+            encoding='utf-8'
+        )
+    else:
+        handler = logging.handlers.RotatingFileHandler(
+            _file_name(), maxBytes=LOG_ROTATION.get('max_bytes', 0),
+            backupCount=LOG_ROTATION.get('backup_count', 5), encoding='utf-8'
+        )
+    handler.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else logging.Formatter(TEXT_FORMAT))
+    return handler
+
+
+def setup_logging():
+    """Configure the root logger once per process according to config.LOG_*"""
+    global _listener
+    if LOG_MODE == 'ini':
+        logging.config.fileConfig(fname=r'logger.ini', disable_existing_loggers=False)
+        return
+    if _listener is not None:
+        return
+
+    records = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    queue_handler.addFilter(ContextFilter(LOG_DEBUG_SAMPLE_RATE))
+    root = logging.getLogger()
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+
+    _listener = logging.handlers.QueueListener(records, _file_handler(), respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Write the queued records and stop the listener thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
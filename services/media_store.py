@@ -0,0 +1,186 @@
+"""
+Content-addressed store of the event photos received by the client bot.
+A file is kept once per file_unique_id (the same for every bot) under
+MEDIA_STORE_DIR/ab/cd/<sha1 of file_unique_id><ext>, written to a temp file
+and renamed into place, so a reader never sees a partial file.
+media_file_table is the index of what is on disk. Processes sharing the directory
+share the index, so config.MEDIA_STORE_MAX_BYTES bounds the whole store: the least
+recently used files are removed above it, whichever process stored them.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import typing
+import uuid
+from datetime import datetime
+
+from sqlalchemy.orm import sessionmaker
+
+import config
+from db.cache import LRUCache
+from db.db_commands import db_get_media_file, db_get_media_files, db_get_media_bytes, db_save_media_file, \
+    db_touch_media_files, db_delete_media_files
+
+logger = logging.getLogger(__name__)
+
+MEDIA_STORE_DIR = getattr(config, 'MEDIA_STORE_DIR', 'media')
+MEDIA_STORE_MAX_BYTES = getattr(config, 'MEDIA_STORE_MAX_BYTES', 1024 * 1024 * 1024)
+TOUCH_BATCH = 100  # last_used of the hits is written in batches
+EVICT_BATCH = 100  # index rows read at once when evicting
+
+
+class MediaStore:
+    """
+    Files are fetched at most once: a file on disk is reused and concurrent
+    fetches of the same file in the process wait for one download.
+    A file may be removed by another process at any time, readers go on
+    without the store when it is gone.
+    """
+
+    def __init__(self, db_session: sessionmaker, root: str = MEDIA_STORE_DIR, max_bytes: int = MEDIA_STORE_MAX_BYTES):
+        self.db_session = db_session
+        self.root = root
+        self.max_bytes = max_bytes
+        self._paths = LRUCache(maxsize=10000, ttl=300)  # file_unique_id -> path relative to root
+        self._fetching = {}  # file_unique_id -> future of the path
+        self._touched = set()
+
+    @staticmethod
+    def _relative_path(file_unique_id: str, file_path: str) -> str:
+        digest = hashlib.sha1(file_unique_id.encode()).hexdigest()
+        return os.path.join(digest[:2], digest[2:4], digest + os.path.splitext(file_path)[1])
+
+    async def lookup(self, media) -> typing.Optional[str]:
+        """
+        Return path of the media file if the store holds it, None otherwise.
+
+        @param media: aiogram Downloadable (PhotoSize, Voice, Document, ...)
+
+        @rtype: str
+        """
+        key = media.file_unique_id
+        relative_path = self._paths.get(key)
+        if relative_path is None:
+            row = await db_get_media_file(self.db_session, key)
+            if row is None:
+                return None
+            relative_path = row.path
+        path = os.path.join(self.root, relative_path)
+        if not os.path.exists(path):
+            # evicted, possibly by another process
+            self._paths.pop(key)
+            return None
+        self._paths.set(key, relative_path)
+        await self._touch(key)
+        return path
+
+    async def fetch(self, media) -> str:
+        """
+        Return path of the media file on disk, downloading it if it is not stored yet.
+
+        @param media: aiogram Downloadable (PhotoSize, Voice, Document, ...)
+
+        @rtype: str
+        """
+        path = await self.lookup(media)
+        if path is not None:
+            return path
+
+        key = media.file_unique_id
+        pending = self._fetching.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        future = self._fetching[key] = asyncio.get_running_loop().create_future()
+        try:
+            path = await self._download(media)
+        except BaseException as err:
+            future.set_exception(err)
+            future.exception()  # retrieved by the waiters if there are any
+            raise
+        else:
+            future.set_result(path)
+            return path
+        finally:
+            del self._fetching[key]
+
+    async def _download(self, media) -> str:
+        file = await media.get_file()
+        relative_path = self._relative_path(media.file_unique_id, file.file_path)
+        path = os.path.join(self.root, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        try:
+            with open(temp_path, 'wb') as destination:
+                await media.bot.download_file(file_path=file.file_path, destination=destination, seek=False)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        size = os.path.getsize(path)
+        await db_save_media_file(self.db_session, media.file_unique_id, relative_path, size, datetime.utcnow())
+        self._paths.set(media.file_unique_id, relative_path)
+        await self._evict(keep=media.file_unique_id)
+        return path
+
+    async def _touch(self, key: str):
+        self._touched.add(key)
+        if len(self._touched) >= TOUCH_BATCH:
+            await self.flush()
+
+    async def _evict(self, keep: str):
+        # the hits of this process count for the order too
+        await self.flush()
+        total = await db_get_media_bytes(self.db_session)
+        removed = 0
+        while total > self.max_bytes:
+            # the new file stays even if it alone is over the budget
+            rows = [row for row in await db_get_media_files(self.db_session, EVICT_BATCH)
+                    if row.file_unique_id != keep]
+            if not rows:
+                break
+            evicted = []
+            for row in rows:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    # a reader that has the file open keeps it until it closes it
+                    os.remove(os.path.join(self.root, row.path))
+                except FileNotFoundError:
+                    pass  # removed by another process
+                except OSError as err:
+                    logger.warning('media store can not remove %s: %s', row.path, err)
+                    continue
+                evicted.append(row.file_unique_id)
+                self._paths.pop(row.file_unique_id)
+                total -= row.size
+            if not evicted:
+                break
+            await db_delete_media_files(self.db_session, evicted)
+            removed += len(evicted)
+        if removed:
+            logger.info('media store evicted %d files, %d bytes are stored', removed, total)
+
+    async def flush(self):
+        """Write last_used of the recently used files to the index"""
+        if self._touched:
+            touched, self._touched = list(self._touched), set()
+            await db_touch_media_files(self.db_session, touched, datetime.utcnow())
+
+
+_store: typing.Optional[MediaStore] = None
+
+
+def media_store(db_session: sessionmaker) -> MediaStore:
+    """Return the media store of the process, both bots share it"""
+    global _store
+    if _store is None:
+        _store = MediaStore(db_session)
+    return _store
+
+
+async def close_media_store():
+    if _store is not None:
+        await _store.flush()
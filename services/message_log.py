@@ -0,0 +1,131 @@
+"""
+Log of the messages relayed between the bots.
+record() only appends the message to a buffer, so the relay never waits for the database;
+the buffer is written with one multi-row INSERT every config.MESSAGE_LOG_FLUSH_INTERVAL
+seconds, as soon as it holds MESSAGE_LOG_BATCH_SIZE messages and on close.
+"""
+import asyncio
+import logging
+import typing
+from datetime import datetime
+
+from aiogram import types
+from sqlalchemy.orm import sessionmaker
+
+import config
+from db.db_commands import db_add_messages
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_LOG_FLUSH_INTERVAL = getattr(config, 'MESSAGE_LOG_FLUSH_INTERVAL', 1.0)  # seconds
+MESSAGE_LOG_BATCH_SIZE = getattr(config, 'MESSAGE_LOG_BATCH_SIZE', 500)
+MESSAGE_LOG_MAX_PENDING = getattr(config, 'MESSAGE_LOG_MAX_PENDING', 100000)  # oldest are dropped above it
+
+
+class MessageLog:
+    """
+    Write-behind buffer of message_log_table rows.
+    Rows of a failed flush are retried on the next one.
+    """
+
+    def __init__(self, db_session: sessionmaker, flush_interval: float = MESSAGE_LOG_FLUSH_INTERVAL,
+                 batch_size: int = MESSAGE_LOG_BATCH_SIZE, max_pending: int = MESSAGE_LOG_MAX_PENDING):
+        self.db_session = db_session
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._pending = []
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+        self._full = asyncio.Event()
+        self._closing = False
+
+    def record(self, message: types.Message, recipient_chat_id: int, client_chat_id: int, event_id: int):
+        """
+        Add the relayed message to the log.
+
+        @param message: aiogram.types.Message received by the bot
+        @param recipient_chat_id: chat of the pair bot the message is relayed to
+        @param client_chat_id: chat of the client bot user of the conversation
+        @param event_id: int
+        """
+        media = getattr(message, message.content_type, None)
+        self._pending.append({
+            'bot': message.bot.data["bot"],
+            'sender_chat_id': message.chat.id,
+            'recipient_chat_id': recipient_chat_id,
+            'client_chat_id': client_chat_id,
+            'event_id': event_id,
+            'content_type': message.content_type,
+            # the largest photo size identifies the photo
+            'file_unique_id': getattr(media[-1] if isinstance(media, list) else media, 'file_unique_id', None),
+            'text': message.text or message.caption,
+            'created': datetime.utcnow(),
+        })
+        if len(self._pending) > self.max_pending:
+            # the database is away for long, keep the latest messages
+            excess = len(self._pending) - self.max_pending
+            del self._pending[:excess]
+            self.dropped += excess
+            logger.warning('message log is full, %d messages dropped', excess)
+        if len(self._pending) >= self.batch_size:
+            self._full.set()
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        while self._pending and not self._closing:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception:
+                # logged by flush, retried on the next round or by close
+                if not self._closing:
+                    await asyncio.sleep(self.flush_interval)
+
+    async def flush(self):
+        """Write all recorded messages to the database"""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            rows, self._pending = self._pending, []
+            written = 0
+            try:
+                for start in range(0, len(rows), self.batch_size):
+                    await db_add_messages(self.db_session, rows[start:start + self.batch_size])
+                    written = min(start + self.batch_size, len(rows))
+            except Exception:
+                logger.exception('message log flush failed, %d messages will be retried', len(rows) - written)
+                raise
+            finally:
+                # also when cancelled, the rows not written go back to the buffer
+                self._pending[:0] = rows[written:]
+
+    async def close(self):
+        """Let the flush in progress finish, then write the rest"""
+        self._closing = True
+        self._full.set()
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+        await self.flush()
+
+
+_log: typing.Optional[MessageLog] = None
+
+
+def message_log(db_session: sessionmaker) -> MessageLog:
+    """Return the message log of the process, both bots share it"""
+    global _log
+    if _log is None:
+        _log = MessageLog(db_session)
+    return _log
+
+
+async def close_message_log():
+    if _log is not None:
+        await _log.close()
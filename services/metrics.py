@@ -0,0 +1,257 @@
+"""
+Metrics of the bots in the Prometheus text format.
+Updates and handler latency are recorded by MetricsMiddleware, database statements
+by SQLAlchemy event hooks, Bot API calls by the outbound scheduler, hits and misses
+of the event and file_id caches are read from db.cache when scraped.
+With config.METRICS_PORT set they are served on http://METRICS_HOST:METRICS_PORT/metrics.
+"""
+import bisect
+import functools
+import logging
+import re
+import time
+import typing
+from collections import defaultdict
+
+from aiogram import Dispatcher, types
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiohttp import web
+from sqlalchemy import event
+
+import config
+from db.cache import cache_stats
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = getattr(config, 'METRICS_HOST', '127.0.0.1')
+METRICS_PORT = getattr(config, 'METRICS_PORT', None)  # None disables the endpoint
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(names: typing.Sequence[str], values: typing.Sequence, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: typing.Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _registry.append(self)
+
+    def samples(self) -> typing.Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}',
+                          *self.samples()])
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: typing.Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values = defaultdict(float)
+
+    def inc(self, *labels, amount: float = 1.0):
+        self.values[labels] += amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield f'{self.name}{_labels(self.labelnames, labels)} {value}'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: typing.Sequence[str] = (),
+                 buckets: typing.Sequence[float] = BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}  # labels -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value: float, *labels):
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    def samples(self):
+        for labels, state in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), state):
+                cumulative += count
+                le = 'le="%s"' % bound
+                yield f'{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}'
+            yield f'{self.name}_sum{_labels(self.labelnames, labels)} {state[-1]}'
+            yield f'{self.name}_count{_labels(self.labelnames, labels)} {cumulative}'
+
+
+class Gauge(Metric):
+    """Gauge read from a callback returning (label values, value) pairs when scraped"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: typing.Sequence[str],
+                 collect: typing.Callable[[], typing.Iterable[typing.Tuple[tuple, float]]]):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def samples(self):
+        for labels, value in self.collect():
+            yield f'{self.name}{_labels(self.labelnames, labels)} {value}'
+
+
+UPDATES = Counter('bot_updates_total', 'Updates received', ('bot', 'type'))
+UPDATE_SECONDS = Histogram('bot_update_seconds', 'Time to process an update', ('bot', 'type'))
+HANDLER_SECONDS = Histogram('bot_handler_seconds', 'Time spent in a handler', ('bot', 'handler'))
+DB_SECONDS = Histogram('db_statement_seconds', 'Time to execute a database statement', ('statement',))
+DB_ERRORS = Counter('db_errors_total', 'Failed database statements', ('statement',))
+API_SECONDS = Histogram('bot_api_seconds', 'Latency of Bot API calls', ('bot', 'method'))
+API_ERRORS = Counter('bot_api_errors_total', 'Failed Bot API calls', ('bot', 'method', 'error'))
+
+_dispatchers = []
+
+
+def _fsm_sessions():
+    for dp in _dispatchers:
+        storage = dp.storage
+        if hasattr(storage, 'sessions_count'):
+            count = storage.sessions_count()
+        else:
+            # aiogram MemoryStorage: chat -> user -> session
+            count = sum(len(users) for users in getattr(storage, 'data', {}).values())
+        yield (dp.bot["bot"],), count
+
+
+FSM_SESSIONS = Gauge('bot_fsm_sessions', 'FSM sessions held in memory', ('bot',), _fsm_sessions)
+
+
+def _cache_stat(name: str):
+    def collect():
+        for cache, stats in cache_stats().items():
+            yield (cache,), stats[name]
+    return collect
+
+
+CACHE_HITS = Gauge('bot_cache_hits', 'Cache lookups that found the entry, since start', ('cache',),
+                   _cache_stat('hits'))
+CACHE_MISSES = Gauge('bot_cache_misses', 'Cache lookups that missed or found an expired entry, since start',
+                     ('cache',), _cache_stat('misses'))
+CACHE_SIZE = Gauge('bot_cache_size', 'Entries held in the cache', ('cache',), _cache_stat('size'))
+
+
+def update_type(update: types.Update) -> str:
+    """Return the kind of the update, e.g. 'message' or 'callback_query'"""
+    return next((key for key in update.values if key != 'update_id'), 'unknown')
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Counts updates by bot and type and records update and handler latency.
+    """
+
+    def __init__(self, bot_name: str):
+        super().__init__()
+        self.bot_name = bot_name
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        data['metrics_started'] = time.perf_counter()
+        UPDATES.inc(self.bot_name, update_type(update))
+
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        started = data.get('metrics_started')
+        if started is not None:
+            UPDATE_SECONDS.observe(time.perf_counter() - started, self.bot_name, update_type(update))
+
+    async def _on_process(self, obj, data: dict):
+        data['metrics_handler'] = current_handler.get().__name__
+        data['metrics_handler_started'] = time.perf_counter()
+
+    async def _on_post_process(self, obj, results, data: dict):
+        started = data.get('metrics_handler_started')
+        if started is not None:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, self.bot_name, data['metrics_handler'])
+
+    on_process_message = _on_process
+    on_post_process_message = _on_post_process
+    on_process_callback_query = _on_process
+    on_post_process_callback_query = _on_post_process
+
+
+def setup_metrics(dp: Dispatcher):
+    """Record metrics of the dispatcher"""
+    dp.middleware.setup(MetricsMiddleware(dp.bot["bot"]))
+    _dispatchers.append(dp)
+
+
+_STATEMENT_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE)\s+"?(\w+)', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=1024)
+def statement_label(statement: str) -> str:
+    """Return the verb and the first table of the SQL statement, e.g. 'SELECT event_table'"""
+    words = statement.split(None, 1)
+    verb = words[0].upper() if words else ''
+    table = _STATEMENT_TABLE.search(statement)
+    return f'{verb} {table.group(1)}' if table else verb
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context.metrics_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    DB_SECONDS.observe(time.perf_counter() - context.metrics_started, statement_label(statement))
+
+
+def _handle_error(exception_context):
+    if exception_context.statement:
+        DB_ERRORS.inc(statement_label(exception_context.statement))
+
+
+def instrument_engine(sync_engine):
+    """Time every statement executed by the engine"""
+    event.listen(sync_engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(sync_engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(sync_engine, 'handle_error', _handle_error)
+
+
+def render_metrics() -> str:
+    """Return all metrics in the Prometheus text format"""
+    return '\n'.join(metric.render() for metric in _registry) + '\n'
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(body=render_metrics().encode(),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def start_metrics_server(port: int = METRICS_PORT, host: str = METRICS_HOST) -> web.AppRunner:
+    """
+    Serve /metrics in the background, return the runner to clean up.
+
+    @param port: int
+    @param host: str
+    """
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info('metrics are served on %s:%s', host, port)
+    return runner
@@ -0,0 +1,340 @@
+"""
+Outbound send scheduler shared by both bots.
+Sends made with one bot token go through one scheduler which keeps them under
+Telegram limits with token buckets (global, per private chat, per group),
+sends higher priority classes first, keeps messages of one chat in order
+and retries after RetryAfter. Handlers enqueue a send and may return at once.
+Every message, photo and edit of the handlers goes through a scheduler, replies with
+answer(); only answers to callback queries (answer_callback_query) are made directly,
+they are not chat messages and have no Telegram send limit.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+import typing
+from collections import deque
+
+from aiogram import Bot, types
+from aiogram.utils.exceptions import MessageNotModified, RetryAfter
+
+import config
+from services.metrics import API_ERRORS, API_SECONDS, Gauge
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_RELAY = 0  # chat relay between the bots
+PRIORITY_DEFAULT = 5
+PRIORITY_CATALOG = 10  # catalog rendering
+
+GLOBAL_RATE = getattr(config, 'OUTBOUND_GLOBAL_RATE', 30.0)  # messages per second for the token
+CHAT_RATE = getattr(config, 'OUTBOUND_CHAT_RATE', 1.0)  # messages per second for a private chat
+CHAT_BURST = getattr(config, 'OUTBOUND_CHAT_BURST', 3)
+GROUP_RATE = getattr(config, 'OUTBOUND_GROUP_RATE', 20 / 60)  # messages per second for a group
+MAX_IN_FLIGHT = getattr(config, 'OUTBOUND_MAX_IN_FLIGHT', 16)
+MAX_RETRIES = 3
+MAX_CHAT_BUCKETS = 10000
+
+
+class TokenBucket:
+    """
+    Classic token bucket: `rate` tokens per second, at most `capacity` tokens saved up.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Return seconds until a token is available"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, now: float, seconds: float):
+        """Spend the tokens so the next one is available only after `seconds`"""
+        self._refill(now)
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class Job:
+    __slots__ = ('method', 'chat_id', 'kwargs', 'priority', 'future', 'enqueued_at', 'retries')
+
+    def __init__(self, method: str, chat_id, kwargs: dict, priority: int):
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.retries = 0
+
+
+class OutboundScheduler:
+    """
+    Scheduler of the sends made with one bot token.
+    Chats with queued jobs wait in a timer heap until their bucket has a token,
+    then in a ready heap ordered by the priority of their first job.
+    """
+
+    def __init__(self, bot: Bot, token: str):
+        self.bot = bot
+        self.token = token
+        self.global_bucket = TokenBucket(GLOBAL_RATE * _rate_share, GLOBAL_RATE * _rate_share)
+        self._chat_buckets = {}
+        self._chat_jobs = {}
+        self._ready = []
+        self._timers = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+        self._loop_task = None
+        self._sending = set()
+        self.depth = 0
+        self.sent = 0
+        self.failed = 0
+        self.retry_after = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def submit(self, method: str, chat_id, priority: int = PRIORITY_DEFAULT, **kwargs) -> asyncio.Future:
+        """
+        Enqueue bot.<method>(chat_id=chat_id, **kwargs) and return future of its result.
+        The future may be ignored, errors are logged by the scheduler.
+
+        @param method: str Bot method name, e.g. 'send_message'
+        @param chat_id: destination chat
+        @param priority: int lower is sent first, see PRIORITY_*
+
+        @rtype: asyncio.Future
+        """
+        job = Job(method, chat_id, kwargs, priority)
+        job.future.add_done_callback(_log_failure)
+        jobs = self._chat_jobs.get(chat_id)
+        if jobs is None:
+            jobs = self._chat_jobs[chat_id] = deque()
+            self._schedule_chat(chat_id, job.priority, time.monotonic())
+        jobs.append(job)
+        self.depth += 1
+        if self._loop_task is None or self._loop_task.done():
+            self._loop_task = asyncio.create_task(self._run())
+        self._wakeup.set()
+        return job.future
+
+    def _bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > MAX_CHAT_BUCKETS:
+                self._prune_buckets()
+            is_group = str(chat_id).startswith(('-', '@'))
+            bucket = TokenBucket(GROUP_RATE, 1) if is_group else TokenBucket(CHAT_RATE, CHAT_BURST)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _prune_buckets(self):
+        # a full bucket of an idle chat is the same as a new one
+        now = time.monotonic()
+        for chat_id, bucket in list(self._chat_buckets.items()):
+            if chat_id not in self._chat_jobs and bucket.delay(now) == 0 and bucket.tokens >= bucket.capacity:
+                del self._chat_buckets[chat_id]
+
+    def _schedule_chat(self, chat_id, priority: int, now: float):
+        ready_at = now + self._bucket(chat_id).delay(now)
+        if ready_at <= now:
+            heapq.heappush(self._ready, (priority, next(self._seq), chat_id))
+        else:
+            heapq.heappush(self._timers, (ready_at, next(self._seq), chat_id))
+
+    async def _run(self):
+        while self.depth:
+            now = time.monotonic()
+            while self._timers and self._timers[0][0] <= now:
+                _, _, chat_id = heapq.heappop(self._timers)
+                heapq.heappush(self._ready, (self._chat_jobs[chat_id][0].priority, next(self._seq), chat_id))
+
+            if not self._ready:
+                self._wakeup.clear()
+                timeout = self._timers[0][0] - now if self._timers else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            global_delay = self.global_bucket.delay(now)
+            if global_delay:
+                await asyncio.sleep(global_delay)
+                continue
+
+            _, _, chat_id = heapq.heappop(self._ready)
+            bucket = self._bucket(chat_id)
+            if bucket.delay(now):
+                # paused by RetryAfter after the chat became ready
+                self._schedule_chat(chat_id, 0, now)
+                continue
+            await self._in_flight.acquire()
+            now = time.monotonic()
+            self.global_bucket.take(now)
+            bucket.take(now)
+            job = self._chat_jobs[chat_id].popleft()
+            task = asyncio.create_task(self._send(job))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, job: Job):
+        chat_id = job.chat_id
+        wait = time.monotonic() - job.enqueued_at
+        bot_id = self.token.split(':')[0]
+        started = time.perf_counter()
+        try:
+            try:
+                with self.bot.with_token(self.token, validate_token=False):
+                    result = await getattr(self.bot, job.method)(chat_id=chat_id, **job.kwargs)
+            finally:
+                API_SECONDS.observe(time.perf_counter() - started, bot_id, job.method)
+        except RetryAfter as err:
+            API_ERRORS.inc(bot_id, job.method, 'RetryAfter')
+            self.retry_after += 1
+            job.retries += 1
+            self._bucket(chat_id).pause(time.monotonic(), err.timeout)
+            if job.retries <= MAX_RETRIES:
+                # back to the front of the chat queue so the chat keeps its order
+                self._chat_jobs[chat_id].appendleft(job)
+            else:
+                self._done(job, wait, error=err)
+        except Exception as err:
+            API_ERRORS.inc(bot_id, job.method, type(err).__name__)
+            self._done(job, wait, error=err)
+        else:
+            self._done(job, wait, result=result)
+        finally:
+            self._in_flight.release()
+            if self._chat_jobs[chat_id]:
+                self._schedule_chat(chat_id, self._chat_jobs[chat_id][0].priority, time.monotonic())
+            else:
+                del self._chat_jobs[chat_id]
+            self._wakeup.set()
+
+    def _done(self, job: Job, wait: float, result=None, error: Exception = None):
+        self.depth -= 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        if error is None:
+            self.sent += 1
+            if not job.future.done():
+                job.future.set_result(result)
+        else:
+            self.failed += 1
+            if not job.future.done():
+                job.future.set_exception(error)
+
+    def stats(self) -> dict:
+        """
+        Return queue depth and wait time counters.
+
+        @rtype: dict
+        """
+        done = self.sent + self.failed
+        return {
+            'depth': self.depth,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retry_after': self.retry_after,
+            'wait_avg': self.wait_total / done if done else 0.0,
+            'wait_max': self.wait_max,
+        }
+
+    async def close(self):
+        """Wait until all queued jobs are sent"""
+        while self.depth and self._loop_task is not None and not self._loop_task.done():
+            await asyncio.sleep(0.05)
+
+
+def _log_failure(future: asyncio.Future):
+    # an edit to the same text and keyboard changes nothing, it is not a failure
+    if not future.cancelled() and future.exception() is not None \
+            and not isinstance(future.exception(), MessageNotModified):
+        logger.warning('outbound send failed: %r', future.exception())
+
+
+_schedulers = {}
+_rate_share = 1.0
+
+
+def set_rate_share(share: float):
+    """
+    Set the share of the global token limit used by this process,
+    e.g. 1/N in each of N worker processes. Call before the first send.
+    Chat limits are not shared: workers relaying to one chat each keep its full rate.
+    """
+    global _rate_share
+    _rate_share = share
+
+
+def scheduler_for(bot: Bot, token: str) -> OutboundScheduler:
+    """
+    Return the scheduler of the token, there is one per token whatever bot sends with it.
+
+    @param bot: aiogram.Bot
+    @param token: str
+
+    @rtype: OutboundScheduler
+    """
+    scheduler = _schedulers.get(token)
+    if scheduler is None:
+        scheduler = _schedulers[token] = OutboundScheduler(bot, token)
+    return scheduler
+
+
+def own_scheduler(bot: Bot) -> OutboundScheduler:
+    """Return scheduler of the bot's own token"""
+    return scheduler_for(bot, bot.data["token"])
+
+
+def pair_scheduler(bot: Bot) -> OutboundScheduler:
+    """Return scheduler of the pair bot token"""
+    return scheduler_for(bot, bot.data["send_to_bot_token"])
+
+
+def answer(message: types.Message, text: str, priority: int = PRIORITY_DEFAULT, **kwargs) -> asyncio.Future:
+    """
+    Send text to the chat of the message with the bot that received it, like message.answer().
+
+    @param message: aiogram.types.Message
+    @param text: str
+    @param priority: int see PRIORITY_*
+    @param kwargs: other send_message arguments, e.g. reply_markup
+
+    @rtype: asyncio.Future
+    """
+    return own_scheduler(message.bot).submit('send_message', message.chat.id, priority, text=text, **kwargs)
+
+
+def schedulers_stats() -> typing.Dict[str, dict]:
+    """
+    Return stats of all schedulers by bot id (the token part before ':').
+
+    @rtype: dict
+    """
+    return {token.split(':')[0]: scheduler.stats() for token, scheduler in _schedulers.items()}
+
+
+OUTBOUND_DEPTH = Gauge(
+    'outbound_queue_depth', 'Sends waiting in the outbound scheduler', ('bot',),
+    lambda: (((bot_id,), stats['depth']) for bot_id, stats in schedulers_stats().items())
+)
+
+
+async def close_schedulers():
+    for scheduler in _schedulers.values():
+        await scheduler.close()
@@ -0,0 +1,144 @@
+"""
+The module relays media between the client and service bots.
+A file already relayed to the other bot is sent by its file_id on that bot.
+Otherwise a file the media store holds (e.g. an event photo) is uploaded from it;
+other files are downloaded with one token and uploaded with the other token through
+an in-memory buffer up to config.RELAY_SPOOL_MAX_SIZE bytes and an anonymous temp file
+above it, without touching the store.
+"""
+import asyncio
+import io
+import logging
+import os
+import tempfile
+from contextlib import asynccontextmanager
+
+from aiogram import types
+from aiogram.utils.exceptions import BadRequest
+
+import config
+from db.db_commands import db_get_file_id, db_save_file_id
+from services.media_store import media_store
+from services.outbound import pair_scheduler, PRIORITY_RELAY
+
+logger = logging.getLogger(__name__)
+
+SPOOL_MAX_SIZE = getattr(config, 'RELAY_SPOOL_MAX_SIZE', 8 * 1024 * 1024)
+LARGE_FILE_SIZE = getattr(config, 'RELAY_LARGE_FILE_SIZE', 8 * 1024 * 1024)
+LARGE_FILE_CONCURRENCY = getattr(config, 'RELAY_LARGE_FILE_CONCURRENCY', 2)
+LARGE_FILE_WAIT = getattr(config, 'RELAY_LARGE_FILE_WAIT', 120)  # seconds
+
+_large_transfers = None
+
+
+def _large_transfers_semaphore() -> asyncio.Semaphore:
+    # created lazily so it is bound to the running event loop
+    global _large_transfers
+    if _large_transfers is None:
+        _large_transfers = asyncio.Semaphore(LARGE_FILE_CONCURRENCY)
+    return _large_transfers
+
+
+def _buffer(file_size: int):
+    """
+    Return buffer for a download of file_size bytes.
+    A real file object is needed: aiogram takes only io.IOBase,
+    which SpooledTemporaryFile is not before Python 3.11.
+    """
+    if 0 < file_size <= SPOOL_MAX_SIZE:
+        return io.BytesIO()
+    return tempfile.TemporaryFile()
+
+
+def media_of(message: types.Message):
+    """
+    Return downloadable object of the message: the largest photo size or the media itself.
+
+    @param message: aiogram.types.Message
+    """
+    if message.content_type == 'photo':
+        return message.photo[-1]
+    return getattr(message, message.content_type)
+
+
+@asynccontextmanager
+async def _large_transfer(file_size: int):
+    # a slot of the shared semaphore for the download of a large file, bounded wait
+    if file_size <= LARGE_FILE_SIZE:
+        yield
+        return
+    semaphore = _large_transfers_semaphore()
+    await asyncio.wait_for(semaphore.acquire(), LARGE_FILE_WAIT)
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+@asynccontextmanager
+async def relay_file(media, filename: str = None):
+    """
+    Yield media as types.InputFile ready for upload.
+    A file held by the media store is read from it, any other file is downloaded
+    into a buffer released on exit.
+    Downloads larger than config.RELAY_LARGE_FILE_SIZE hold a slot of a shared semaphore
+    until the file is in the buffer, so several files of one album never wait
+    for each other; asyncio.TimeoutError after config.RELAY_LARGE_FILE_WAIT seconds without a slot.
+
+    @param media: aiogram Downloadable (PhotoSize, Voice, Document, ...)
+    @param filename: str name for the upload, media.file_name or the name in Telegram storage by default
+    """
+    file_size = getattr(media, 'file_size', None) or 0
+    filename = filename or getattr(media, 'file_name', None)
+    source = None
+    try:
+        path = await media_store(media.bot.get("db")).lookup(media)
+        if path is not None:
+            try:
+                source = open(path, 'rb')
+                filename = filename or os.path.basename(path)
+            except FileNotFoundError:
+                pass  # evicted since the lookup
+        if source is None:
+            source = _buffer(file_size)
+            async with _large_transfer(file_size):
+                file = await media.get_file()
+                await media.bot.download_file(file_path=file.file_path, destination=source, seek=True)
+            filename = filename or os.path.basename(file.file_path)
+        yield types.InputFile(source, filename=filename)
+    finally:
+        if source is not None:
+            source.close()
+
+
+async def relay_media(message: types.Message, chat_id, **kwargs) -> types.Message:
+    """
+    Send media of the message to chat_id through the pair bot.
+    Repeated media goes by the file_id remembered from the first upload,
+    new media is downloaded and uploaded with relay_file.
+
+    @param message: aiogram.types.Message
+    @param chat_id: chat of the pair bot
+    @param kwargs: other arguments of the send_<content_type> method
+
+    @rtype: aiogram.types.Message
+    """
+    bot = message.bot
+    media = media_of(message)
+    method = 'send_' + message.content_type
+    to_bot = bot.data["send_to_bot"]
+    scheduler = pair_scheduler(bot)
+
+    file_id = await db_get_file_id(bot.get("db"), media.file_unique_id, to_bot)
+    if file_id is not None:
+        try:
+            return await scheduler.submit(
+                method, chat_id, PRIORITY_RELAY, **{message.content_type: file_id}, **kwargs
+            )
+        except BadRequest as err:
+            logger.info('file_id of %s is rejected by %s: %s', media.file_unique_id, to_bot, err)
+
+    async with relay_file(media) as file_:
+        sent = await scheduler.submit(method, chat_id, PRIORITY_RELAY, **{message.content_type: file_}, **kwargs)
+    await db_save_file_id(bot.get("db"), media.file_unique_id, to_bot, media_of(sent).file_id)
+    return sent
@@ -0,0 +1,129 @@
+"""
+Routing table of the chats between the client and service bots.
+A route is built once when a chat is opened and looked up by every relayed message,
+so the hot path does no caption parsing and no database I/O.
+"""
+import typing
+
+from aiogram import types
+from aiogram.dispatcher import FSMContext
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from sqlalchemy.exc import NoResultFound
+
+import config
+from db.cache import LRUCache, add_invalidation_listener
+from db.db_commands import db_get_item_by_id
+import handlers.keyboards as keyb
+
+
+class Route(typing.NamedTuple):
+    peer_chat_id: int
+    event_id: int
+    sender_name: str
+    text_prefix: str
+    keyboard: InlineKeyboardMarkup
+
+
+# routes are rebuilt from FSM data on a miss, so the table only has to hold active chats
+routes = LRUCache(maxsize=100000, ttl=24 * 3600.0)
+DELETED_EVENT_NAME = "(событие удалено)"
+
+
+async def build_route(bot, chat_id: int, sender_name: str, peer_chat_id: int, event_id: int) -> Route:
+    """
+    Build the route of messages sent from chat_id of the bot and put it to the table.
+
+    @param bot: aiogram.Bot the route starts from
+    @param chat_id: int
+    @param sender_name: str full name of the user writing from chat_id
+    @param peer_chat_id: int chat of the pair bot
+    @param event_id: int
+
+    @rtype: Route
+    """
+    try:
+        event_name = (await db_get_item_by_id(bot.get("db"), event_id)).event_name
+    except NoResultFound:
+        # the event was deleted, the open chat goes on
+        event_name = DELETED_EVENT_NAME
+    url = f"{config.CLIENT_BOT_URL}looktoid_{str(event_id)}"
+    keyboard = InlineKeyboardMarkup()
+    if bot.data["bot"] == 'CLIENT_BOT':
+        keyboard.row(
+            InlineKeyboardButton(
+                text="Ответить",
+                callback_data=f"answeruser_{chat_id}_{event_id}"
+            ),
+            InlineKeyboardButton(
+                text="Посмотреть событие",
+                url=url
+            )
+        )
+        text_prefix = f"Сообщение:{event_name},\n" + \
+                      f"{sender_name}: "
+    else:
+        keyboard.row(
+            InlineKeyboardButton(
+                text="Ответить",
+                callback_data=keyb.event_callback.new(action="connect", event_id=event_id)
+            ),
+            InlineKeyboardButton(
+                text="Посмотреть событие",
+                url=url
+            )
+        )
+        text_prefix = f"Сообщение от владельца события {event_name}\n"
+
+    route = Route(peer_chat_id, event_id, sender_name, text_prefix, keyboard)
+    routes.set((bot.data["bot"], chat_id), route)
+    return route
+
+
+def find_route(bot: str, chat_id: int) -> typing.Optional[Route]:
+    """
+    Return route of the chat if it is in the table.
+
+    @param bot: str 'CLIENT_BOT' or 'SERVICE_BOT'
+    @param chat_id: int
+
+    @rtype: Route
+    """
+    return routes.get((bot, chat_id))
+
+
+async def get_route(message: types.Message, state: FSMContext) -> Route:
+    """
+    Return route of the chat the message is sent from.
+    After restart the route is rebuilt once from FSM data of the chat.
+
+    @param message: aiogram.types.Message
+    @param state: FSMContext of the chat
+
+    @rtype: Route
+    """
+    route = find_route(message.bot.data["bot"], message.chat.id)
+    if route is not None:
+        return route
+    state_data = await state.get_data()
+    return await build_route(
+        message.bot,
+        message.chat.id,
+        message.from_user.full_name,
+        state_data['peer_chat_id'],
+        state_data['event_id']
+    )
+
+
+def drop_route(bot: str, chat_id: int):
+    """Remove route of the chat when the chat is closed"""
+    routes.pop((bot, chat_id))
+
+
+def drop_event_routes(event_ids: typing.List[int]):
+    """Remove routes of the deleted events, the chats rebuild them from FSM data"""
+    if event_ids:
+        event_ids = set(event_ids)
+        routes.pop_matching(lambda route: route.event_id in event_ids)
+
+
+add_invalidation_listener(drop_event_routes)
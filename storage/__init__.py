@@ -0,0 +1,29 @@
+"""
+FSM storages of the bots.
+config.FSM_STORAGE selects one of 'memory', 'sql' or 'redis'.
+"""
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher.storage import BaseStorage
+from sqlalchemy.orm import sessionmaker
+
+import config
+from storage.redis import RedisStorage
+from storage.sql import SqlStorage
+
+
+def create_storage(bot: str, db_session: sessionmaker) -> BaseStorage:
+    """
+    Return FSM storage configured for the bot.
+
+    @param bot: str 'CLIENT_BOT' or 'SERVICE_BOT'
+    @param db_session: sessionmaker
+
+    @rtype: BaseStorage
+    """
+    kind = getattr(config, 'FSM_STORAGE', 'memory')
+    flush_interval = getattr(config, 'FSM_FLUSH_INTERVAL', 1.0)
+    if kind == 'sql':
+        return SqlStorage(db_session, bot, flush_interval=flush_interval)
+    if kind == 'redis':
+        return RedisStorage(bot, flush_interval=flush_interval, **getattr(config, 'FSM_REDIS', {}))
+    return MemoryStorage()
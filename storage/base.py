@@ -0,0 +1,161 @@
+"""
+Base of the durable FSM storages: a hot in-memory layer with write-behind batching.
+Reads are served from memory, a session missing there (e.g. after restart) is loaded
+from the backend once. Writes mark the session dirty; dirty sessions are written to
+the backend in one batch every flush_interval seconds and on close.
+"""
+import asyncio
+import copy
+import logging
+import typing
+from collections import OrderedDict
+from itertools import islice
+
+from aiogram.dispatcher.storage import BaseStorage
+
+logger = logging.getLogger(__name__)
+
+Address = typing.Tuple[str, str]
+
+
+class WriteBehindStorage(BaseStorage):
+    """
+    Backends implement _load and _save.
+    A session record is {'state': str or None, 'data': dict}, None means the session is removed.
+    At most hot_limit sessions not waiting for a flush are kept in memory.
+    """
+
+    def __init__(self, flush_interval: float = 1.0, hot_limit: int = 10000):
+        self.flush_interval = flush_interval
+        self.hot_limit = hot_limit
+        self._hot = OrderedDict()
+        self._dirty = set()
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+
+    async def _load(self, address: Address) -> typing.Optional[dict]:
+        """Return stored record of the session or None"""
+        raise NotImplementedError
+
+    async def _save(self, records: typing.Dict[Address, typing.Optional[dict]]):
+        """Store records in one batch, None values are deleted"""
+        raise NotImplementedError
+
+    async def _record(self, chat, user) -> typing.Tuple[Address, dict]:
+        address = tuple(map(str, self.check_address(chat=chat, user=user)))
+        record = self._hot.get(address)
+        if record is None:
+            record = await self._load(address) or {'state': None, 'data': {}}
+            # a concurrent call may have created the record while loading
+            record = self._hot.setdefault(address, record)
+            self._evict()
+        else:
+            self._hot.move_to_end(address)
+        return address, record
+
+    def _evict(self):
+        # drop least recently used sessions already written to the backend
+        for address in list(islice(self._hot, max(len(self._hot) - self.hot_limit, 0))):
+            if address not in self._dirty:
+                del self._hot[address]
+
+    def _touch(self, address: Address, record: dict):
+        self._dirty.add(address)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        while self._dirty:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                pass  # logged by flush, retried on the next round
+
+    async def flush(self):
+        """Write all dirty sessions to the backend"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, set()
+            records = {}
+            for address in dirty:
+                record = self._hot.get(address)
+                is_empty = record is None or (record['state'] is None and not record['data'])
+                records[address] = None if is_empty else copy.deepcopy(record)
+            saved = False
+            try:
+                await self._save(records)
+                saved = True
+            except Exception:
+                logger.exception('FSM storage flush failed, %d sessions will be retried', len(records))
+                raise
+            finally:
+                # also when the flush is cancelled, e.g. by close()
+                if not saved:
+                    self._dirty |= dirty
+            # finished sessions leave the hot layer once the backend has forgotten them too
+            for address, record in records.items():
+                if record is None and address not in self._dirty:
+                    self._hot.pop(address, None)
+
+    async def close(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self.flush()
+        self._hot.clear()
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        _, record = await self._record(chat, user)
+        return record['state'] or self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[str] = None) -> typing.Dict:
+        _, record = await self._record(chat, user)
+        return copy.deepcopy(record['data'])
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        address, record = await self._record(chat, user)
+        record['state'] = self.resolve_state(state)
+        self._touch(address, record)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        address, record = await self._record(chat, user)
+        record['data'] = copy.deepcopy(data) if data else {}
+        self._touch(address, record)
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        address, record = await self._record(chat, user)
+        record['data'].update(data or {}, **kwargs)
+        self._touch(address, record)
+
+    async def reset_state(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          with_data: typing.Optional[bool] = True):
+        address, record = await self._record(chat, user)
+        record['state'] = None
+        if with_data:
+            record['data'] = {}
+        self._touch(address, record)
+
+    def sessions_count(self) -> int:
+        """Return number of sessions in the hot layer"""
+        return len(self._hot)
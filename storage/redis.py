@@ -0,0 +1,133 @@
+"""
+FSM storage kept in a server speaking the Redis protocol (RESP).
+Only GET, SET and DEL are used, so any Redis-compatible server, including
+a local stand-in, can back it. Batches are sent pipelined over one connection.
+"""
+import asyncio
+import json
+import typing
+
+from storage.base import WriteBehindStorage, Address
+
+
+class RedisProtocolError(Exception):
+    pass
+
+
+class RespConnection:
+    """
+    Minimal RESP client: sends commands pipelined and reads their replies in order.
+    """
+
+    def __init__(self, host: str = 'localhost', port: int = 6379, db: int = 0, password: str = None):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        init = []
+        if self.password:
+            init.append(('AUTH', self.password))
+        if self.db:
+            init.append(('SELECT', self.db))
+        if init:
+            await self._pipeline(init)
+
+    @staticmethod
+    def _encode(command: typing.Sequence) -> bytes:
+        parts = [b'*%d\r\n' % len(command)]
+        for arg in command:
+            arg = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    async def _read_reply(self):
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError('connection closed by the server')
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode()
+        if kind == b'-':
+            raise RedisProtocolError(payload.decode())
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length == -1:
+                return None
+            return (await self._reader.readexactly(length + 2))[:-2]
+        if kind == b'*':
+            length = int(payload)
+            if length == -1:
+                return None
+            return [await self._read_reply() for _ in range(length)]
+        raise RedisProtocolError(f'unexpected reply {line!r}')
+
+    async def _pipeline(self, commands: typing.Sequence[typing.Sequence]) -> list:
+        self._writer.write(b''.join(self._encode(command) for command in commands))
+        await self._writer.drain()
+        return [await self._read_reply() for _ in commands]
+
+    async def pipeline(self, commands: typing.Sequence[typing.Sequence]) -> list:
+        """
+        Send commands in one write and return their replies.
+
+        @param commands: list of commands, e.g. [('SET', key, value), ('DEL', key)]
+
+        @rtype: list
+        """
+        async with self._lock:
+            if self._writer is None or self._writer.is_closing():
+                await self._connect()
+            try:
+                return await self._pipeline(commands)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self._writer.close()
+                self._writer = None
+                raise
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            await self._writer.wait_closed()
+            self._writer = None
+
+
+class RedisStorage(WriteBehindStorage):
+    """
+    Stores one JSON value {"state": ..., "data": {...}} per session under
+    "<prefix>:<bot>:<chat>:<user>".
+    """
+
+    def __init__(self, bot: str, host: str = 'localhost', port: int = 6379, db: int = 0,
+                 password: str = None, prefix: str = 'fsm', flush_interval: float = 1.0):
+        super().__init__(flush_interval)
+        self.bot = bot
+        self.prefix = prefix
+        self.redis = RespConnection(host, port, db, password)
+
+    def _key(self, address: Address) -> str:
+        chat, user = address
+        return f'{self.prefix}:{self.bot}:{chat}:{user}'
+
+    async def _load(self, address: Address) -> typing.Optional[dict]:
+        value, = await self.redis.pipeline([('GET', self._key(address))])
+        return json.loads(value) if value else None
+
+    async def _save(self, records: typing.Dict[Address, typing.Optional[dict]]):
+        commands = [
+            ('DEL', self._key(address)) if record is None
+            else ('SET', self._key(address), json.dumps(record, ensure_ascii=False))
+            for address, record in records.items()
+        ]
+        await self.redis.pipeline(commands)
+
+    async def close(self):
+        await super().close()
+        await self.redis.close()
@@ -0,0 +1,79 @@
+"""
+FSM storage kept in the application database (SQLite/aiosqlite by default)
+"""
+import json
+import typing
+
+from sqlalchemy import select, delete, tuple_
+from sqlalchemy.orm import sessionmaker
+
+from db.engine import bind_params_limit
+from db.models import FsmSessionTable
+from storage.base import WriteBehindStorage, Address
+
+RECORD_COLUMNS = ('peer_chat_id', 'event_id')
+
+
+class SqlStorage(WriteBehindStorage):
+    """
+    Stores one fsm_session_table row per session of the bot.
+    """
+
+    def __init__(self, db_session: sessionmaker, bot: str, flush_interval: float = 1.0):
+        super().__init__(flush_interval)
+        self.db_session = db_session
+        self.bot = bot
+
+    async def _load(self, address: Address) -> typing.Optional[dict]:
+        chat, user = address
+        sql = select(FsmSessionTable).where(
+            FsmSessionTable.bot == self.bot,
+            FsmSessionTable.chat == chat,
+            FsmSessionTable.user == user
+        )
+        async with self.db_session() as session:
+            row = await session.scalar(sql)
+        if row is None:
+            return None
+        data = json.loads(row.data) if row.data else {}
+        for column in RECORD_COLUMNS:
+            if getattr(row, column) is not None:
+                data[column] = getattr(row, column)
+        return {'state': row.state, 'data': data}
+
+    async def _save(self, records: typing.Dict[Address, typing.Optional[dict]]):
+        # DELETE of the batch, then INSERT of the live sessions, in statements under the bind parameter limit
+        rows = []
+        for (chat, user), record in records.items():
+            if record is None:
+                continue
+            data = dict(record['data'])
+            columns = {column: data.pop(column, None) for column in RECORD_COLUMNS}
+            rows.append(
+                FsmSessionTable(
+                    bot=self.bot,
+                    chat=chat,
+                    user=user,
+                    state=record['state'],
+                    data=json.dumps(data, ensure_ascii=False) if data else None,
+                    **columns
+                )
+            )
+        addresses = list(records)
+        async with self.db_session() as session:
+            limit = bind_params_limit(session.bind.dialect.name)
+            delete_chunk = (limit - 1) // 2  # bot, then chat and user of every session
+            insert_chunk = limit // len(FsmSessionTable.__table__.columns)
+            async with session.begin():
+                for start in range(0, len(addresses), delete_chunk):
+                    await session.execute(
+                        delete(FsmSessionTable).where(
+                            FsmSessionTable.bot == self.bot,
+                            tuple_(FsmSessionTable.chat, FsmSessionTable.user).in_(
+                                addresses[start:start + delete_chunk]
+                            )
+                        )
+                    )
+                for start in range(0, len(rows), insert_chunk):
+                    session.add_all(rows[start:start + insert_chunk])
+                    await session.flush()
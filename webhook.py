@@ -0,0 +1,118 @@
+"""
+Webhook entry point serving both bots from one aiohttp application.
+Telegram POSTs updates of the client bot to /webhook/client and of the service bot
+to /webhook/service. The request is answered with 200 at once, the update is
+processed in the background with a bounded number of updates in progress.
+Recorded Update JSON can be POSTed to these paths to test the bots locally.
+"""
+import asyncio
+import logging
+import typing
+
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+
+import config
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_PATHS = {'CLIENT_BOT': 'client', 'SERVICE_BOT': 'service'}
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+WEBHOOK_HOST = getattr(config, 'WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = getattr(config, 'WEBHOOK_PORT', 8080)
+WEBHOOK_BASE_URL = getattr(config, 'WEBHOOK_BASE_URL', None)  # public URL, e.g. 'https://example.com'
+WEBHOOK_SECRET = getattr(config, 'WEBHOOK_SECRET', None)
+WEBHOOK_MAX_CONCURRENT = getattr(config, 'WEBHOOK_MAX_CONCURRENT', 64)
+WEBHOOK_MAX_PENDING = getattr(config, 'WEBHOOK_MAX_PENDING', 1000)
+
+
+class UpdateRunner:
+    """
+    Processes updates in background tasks, at most max_concurrent at a time.
+    """
+
+    def __init__(self, max_concurrent: int, max_pending: int):
+        self.max_pending = max_pending
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._tasks = set()
+
+    @property
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    def submit(self, dp: Dispatcher, update: types.Update):
+        task = asyncio.create_task(self._process(dp, update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, dp: Dispatcher, update: types.Update):
+        async with self._semaphore:
+            Bot.set_current(dp.bot)
+            Dispatcher.set_current(dp)
+            try:
+                await dp.updates_handler.notify(update)
+            except Exception:
+                logger.exception('update %s failed', update.update_id)
+
+    async def wait_closed(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+async def webhook_handler(request: web.Request) -> web.Response:
+    dp = request.app['dispatchers'].get(request.match_info['bot'])
+    if dp is None:
+        raise web.HTTPNotFound()
+    if WEBHOOK_SECRET and request.headers.get(SECRET_HEADER) != WEBHOOK_SECRET:
+        raise web.HTTPForbidden()
+
+    runner = request.app['runner']
+    if runner.pending >= runner.max_pending:
+        # Telegram redelivers the update later
+        raise web.HTTPServiceUnavailable()
+
+    update = types.Update(**(await request.json()))
+    runner.submit(dp, update)
+    return web.Response(status=200)
+
+
+def create_webhook_app(dispatchers: typing.Iterable[Dispatcher]) -> web.Application:
+    """
+    Return aiohttp application serving webhooks of the dispatchers.
+
+    @param dispatchers: dispatchers of the client and service bots
+
+    @rtype: aiohttp.web.Application
+    """
+    app = web.Application()
+    app['dispatchers'] = {WEBHOOK_PATHS[dp.bot["bot"]]: dp for dp in dispatchers}
+    app['runner'] = UpdateRunner(WEBHOOK_MAX_CONCURRENT, WEBHOOK_MAX_PENDING)
+    app.router.add_post('/webhook/{bot}', webhook_handler)
+    return app
+
+
+async def run_webhook(dispatchers: typing.List[Dispatcher]):
+    """
+    Register webhooks (if config.WEBHOOK_BASE_URL is set) and serve them until cancelled.
+
+    @param dispatchers: dispatchers of the client and service bots
+    """
+    app = create_webhook_app(dispatchers)
+    if WEBHOOK_BASE_URL:
+        for path, dp in app['dispatchers'].items():
+            await dp.bot.set_webhook(
+                f"{WEBHOOK_BASE_URL}/webhook/{path}",
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONCURRENT,
+            )
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logger.info('webhook server is listening on %s:%s', WEBHOOK_HOST, WEBHOOK_PORT)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await app['runner'].wait_closed()
+        await runner.cleanup()
@@ -0,0 +1,409 @@
+"""
+Supervisor mode: updates are received once (long polling or webhook) and
+dispatched to worker processes by consistent hashing on chat id.
+Every chat is always handled by the same worker, which runs updates of one chat
+in order, so FSM conversations keep their order while different chats use
+different cores. Workers that die are restarted. SIGHUP (or POST /workers/{n}/restart
+of the webhook server when WEBHOOK_SECRET is set) restarts workers gracefully one at
+a time: the old process finishes the updates it has taken, the updates queued
+meanwhile wait for the new one.
+Outbound limits per chat are kept by each worker, and a peer chat can get messages
+relayed by several workers, so it may receive up to WORKERS * OUTBOUND_CHAT_RATE;
+Telegram answers the excess with RetryAfter, which the scheduler waits out.
+Every worker caches events, their captions and chat routes; the ids of events a worker
+deletes go to the supervisor, which puts them in the queues of the other workers,
+so they drop the events from their caches after the updates dispatched before.
+"""
+import asyncio
+import bisect
+import functools
+import hashlib
+import logging
+import multiprocessing
+import signal
+import time
+import typing
+
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+
+import config
+from services.outbound import set_rate_share
+
+logger = logging.getLogger(__name__)
+
+WORKERS = getattr(config, 'WORKERS', 0)
+VIRTUAL_NODES = 64
+STATS_INTERVAL = 60
+STOP = None
+INVALIDATE = 'INVALIDATE'  # queue item (INVALIDATE, event_ids) in place of (bot_name, update)
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Consistent hash ring of worker indexes with virtual nodes.
+    """
+
+    def __init__(self, workers: int, virtual_nodes: int = VIRTUAL_NODES):
+        ring = sorted(
+            (_hash(f'worker-{worker}-{node}'), worker)
+            for worker in range(workers) for node in range(virtual_nodes)
+        )
+        self._keys = [key for key, _ in ring]
+        self._workers = [worker for _, worker in ring]
+
+    def get(self, chat_id) -> int:
+        """Return index of the worker owning the chat"""
+        index = bisect.bisect(self._keys, _hash(str(chat_id))) % len(self._keys)
+        return self._workers[index]
+
+
+def update_chat_id(update: dict):
+    """
+    Return id of the chat the raw update belongs to, the user id if it has no chat.
+
+    @param update: dict Update JSON
+
+    @rtype: int
+    """
+    for key, value in update.items():
+        if not isinstance(value, dict):
+            continue
+        if 'chat' in value:
+            return value['chat']['id']
+        if isinstance(value.get('message'), dict):
+            return value['message']['chat']['id']
+        if 'from' in value:
+            return value['from']['id']
+    return 0
+
+
+class WorkerStats:
+    """
+    Counters of one worker shared between the worker and the supervisor.
+    """
+
+    def __init__(self, ctx):
+        self.processed = ctx.Value('q', 0)
+        self.failed = ctx.Value('q', 0)
+        self.in_progress = ctx.Value('q', 0)
+        self.busy_time = ctx.Value('d', 0.0)
+
+
+async def _worker_loop(index: int, workers: int, queue, invalidations, stats: WorkerStats):
+    # imported here so the supervisor does not open the database
+    from db.cache import drop_events, set_invalidation_publisher
+    from db.engine import create_db_session
+    from main__ import create_client_dispatcher, create_service_dispatcher, close_dispatcher
+    from services.expiry import start_expiry_sweeper
+    from services.metrics import METRICS_PORT, start_metrics_server
+
+    async_sessionmaker = await create_db_session()
+    # one sweeper for the whole pool
+    sweeper = start_expiry_sweeper(async_sessionmaker) if index == 0 else None
+    # every worker serves its own metrics on the next ports
+    metrics = await start_metrics_server(METRICS_PORT + 1 + index) if METRICS_PORT else None
+    dispatchers = {
+        dp.bot["bot"]: dp
+        for dp in (create_client_dispatcher(async_sessionmaker), create_service_dispatcher(async_sessionmaker))
+    }
+    chains = {}
+    loop = asyncio.get_running_loop()
+    # the token limits are shared by all workers
+    set_rate_share(1 / workers)
+    set_invalidation_publisher(lambda event_ids: invalidations.put((index, event_ids)))
+
+    def forget_chain(key, task: asyncio.Task):
+        if chains.get(key) is task:
+            del chains[key]
+
+    async def process(previous, bot_name: str, update: dict):
+        if previous is not None:
+            await asyncio.wait([previous])
+        dp = dispatchers[bot_name]
+        Bot.set_current(dp.bot)
+        Dispatcher.set_current(dp)
+        with stats.in_progress.get_lock():
+            stats.in_progress.value += 1
+        started = time.monotonic()
+        try:
+            await dp.updates_handler.notify(types.Update(**update))
+        except Exception:
+            logger.exception('worker %d: update %s failed', index, update.get('update_id'))
+            with stats.failed.get_lock():
+                stats.failed.value += 1
+        finally:
+            with stats.in_progress.get_lock():
+                stats.in_progress.value -= 1
+            with stats.processed.get_lock():
+                stats.processed.value += 1
+            with stats.busy_time.get_lock():
+                stats.busy_time.value += time.monotonic() - started
+
+    while True:
+        item = await loop.run_in_executor(None, queue.get)
+        if item is STOP:
+            break
+        if item[0] == INVALIDATE:
+            drop_events(item[1])
+            continue
+        bot_name, update = item
+        key = (bot_name, update_chat_id(update))
+        task = asyncio.create_task(process(chains.get(key), bot_name, update))
+        chains[key] = task
+        task.add_done_callback(functools.partial(forget_chain, key))
+
+    if sweeper is not None:
+        sweeper.cancel()
+    if chains:
+        await asyncio.wait(list(chains.values()))
+    for dp in dispatchers.values():
+        await close_dispatcher(dp)
+    if metrics is not None:
+        await metrics.cleanup()
+    # the aiosqlite threads would keep the process from exiting
+    await async_sessionmaker.kw['bind'].dispose()
+
+
+def worker_main(index: int, workers: int, queue, invalidations, stats: WorkerStats):
+    """Entry point of a worker process"""
+    asyncio.run(_worker_loop(index, workers, queue, invalidations, stats))
+
+
+class WorkerPool:
+    """
+    Worker processes with one update queue each.
+    """
+
+    def __init__(self, workers: int):
+        self._ctx = multiprocessing.get_context('spawn')
+        self.ring = HashRing(workers)
+        self.queues = [self._ctx.Queue() for _ in range(workers)]
+        self.invalidations = self._ctx.Queue()  # (worker index, event_ids) from the workers
+        self.stats_ = [WorkerStats(self._ctx) for _ in range(workers)]
+        self.processes = [None] * workers
+        self.dispatched = [0] * workers
+        self._restarting = set()
+
+    def _start(self, index: int):
+        process = self._ctx.Process(
+            target=worker_main,
+            args=(index, len(self.processes), self.queues[index], self.invalidations, self.stats_[index]),
+            name=f'bot-worker-{index}',
+            daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+
+    def start(self):
+        for index in range(len(self.processes)):
+            self._start(index)
+
+    def dispatch(self, bot_name: str, update: dict):
+        """
+        Send the raw update to the worker owning its chat.
+
+        @param bot_name: str 'CLIENT_BOT' or 'SERVICE_BOT'
+        @param update: dict Update JSON
+        """
+        index = self.ring.get(update_chat_id(update))
+        self.dispatched[index] += 1
+        self.queues[index].put((bot_name, update))
+
+    async def restart_worker(self, index: int, timeout: float = 30):
+        """
+        Restart worker gracefully: it finishes the updates taken from its queue and exits,
+        then a new process continues with the same queue.
+        """
+        self._restarting.add(index)
+        try:
+            process = self.processes[index]
+            self.queues[index].put(STOP)
+            await asyncio.get_running_loop().run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                process.terminate()
+            self._start(index)
+        finally:
+            self._restarting.discard(index)
+
+    async def restart_all(self, timeout: float = 30):
+        """Restart the workers gracefully one after another, e.g. to load new code"""
+        for index in range(len(self.processes)):
+            await self.restart_worker(index, timeout)
+            logger.info('worker %d restarted', index)
+
+    async def forward_invalidations(self):
+        """Pass the event ids deleted by a worker to the other workers, until stop()"""
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await loop.run_in_executor(None, self.invalidations.get)
+            if item is STOP:
+                break
+            source, event_ids = item
+            for index, queue in enumerate(self.queues):
+                if index != source:
+                    queue.put((INVALIDATE, event_ids))
+
+    def revive(self):
+        """Start again the workers that died"""
+        for index, process in enumerate(self.processes):
+            if index not in self._restarting and not process.is_alive():
+                logger.error('worker %d exited with %s, restarting', index, process.exitcode)
+                self._start(index)
+
+    def stats(self) -> typing.List[dict]:
+        """
+        Return load stats of the workers.
+
+        @rtype: list
+        """
+        return [
+            {
+                'worker': index,
+                'pid': self.processes[index].pid if self.processes[index] else None,
+                'dispatched': self.dispatched[index],
+                'processed': stats.processed.value,
+                'failed': stats.failed.value,
+                'in_progress': stats.in_progress.value,
+                'queued': self.dispatched[index] - stats.processed.value - stats.in_progress.value,
+                'busy_time': round(stats.busy_time.value, 3),
+            }
+            for index, stats in enumerate(self.stats_)
+        ]
+
+    async def stop(self, timeout: float = 30):
+        for queue in self.queues:
+            queue.put(STOP)
+        self.invalidations.put(STOP)
+        loop = asyncio.get_running_loop()
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                process.terminate()
+
+
+async def _poll(bot: Bot, pool: WorkerPool):
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=20)
+        except Exception:
+            logger.exception('%s: getUpdates failed', bot["bot"])
+            await asyncio.sleep(5)
+            continue
+        for update in updates:
+            pool.dispatch(bot["bot"], update.to_python())
+            offset = update.update_id + 1
+
+
+async def _supervise(pool: WorkerPool):
+    last_stats = time.monotonic()
+    while True:
+        await asyncio.sleep(1)
+        pool.revive()
+        if time.monotonic() - last_stats >= STATS_INTERVAL:
+            last_stats = time.monotonic()
+            logger.info('workers load: %s', pool.stats())
+
+
+def create_supervisor_app(pool: WorkerPool, bots: typing.Dict[str, str]) -> web.Application:
+    """
+    Return aiohttp application receiving webhooks of the bots and dispatching them to the pool.
+
+    @param pool: WorkerPool
+    @param bots: dict webhook path -> bot name
+    """
+    from webhook import SECRET_HEADER, WEBHOOK_SECRET
+
+    async def handler(request: web.Request) -> web.Response:
+        bot_name = bots.get(request.match_info['bot'])
+        if bot_name is None:
+            raise web.HTTPNotFound()
+        if WEBHOOK_SECRET and request.headers.get(SECRET_HEADER) != WEBHOOK_SECRET:
+            raise web.HTTPForbidden()
+        pool.dispatch(bot_name, await request.json())
+        return web.Response(status=200)
+
+    async def stats(request: web.Request) -> web.Response:
+        return web.json_response(pool.stats())
+
+    async def restart(request: web.Request) -> web.Response:
+        if request.headers.get(SECRET_HEADER) != WEBHOOK_SECRET:
+            raise web.HTTPForbidden()
+        index = int(request.match_info['index'])
+        if not 0 <= index < len(pool.processes):
+            raise web.HTTPNotFound()
+        await pool.restart_worker(index)
+        return web.json_response(pool.stats()[index])
+
+    app = web.Application()
+    app.router.add_post('/webhook/{bot}', handler)
+    app.router.add_get('/workers', stats)
+    if WEBHOOK_SECRET:
+        # the webhook port is public, restarts need the secret
+        app.router.add_post(r'/workers/{index:\d+}/restart', restart)
+    return app
+
+
+async def run_supervisor(workers: int = WORKERS):
+    """
+    Start the worker pool and feed it with updates of both bots until cancelled.
+    config.RUN_MODE selects long polling or webhook as the source of updates.
+
+    @param workers: int number of worker processes
+    """
+    from main__ import create_bot
+    from webhook import WEBHOOK_PATHS, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_BASE_URL, WEBHOOK_SECRET
+
+    pool = WorkerPool(workers)
+    pool.start()
+    bots = []
+    for name, token in (('CLIENT_BOT', config.CLIENT_TOKEN), ('SERVICE_BOT', config.SERVICE_TOKEN)):
+        bot = create_bot(token)
+        bot["bot"] = name
+        bots.append(bot)
+
+    tasks = [asyncio.create_task(_supervise(pool)), asyncio.create_task(pool.forward_invalidations())]
+    rolling_restart = None
+
+    def on_sighup():
+        nonlocal rolling_restart
+        if rolling_restart is None or rolling_restart.done():
+            logger.info('SIGHUP: restarting the workers one at a time')
+            rolling_restart = asyncio.create_task(pool.restart_all())
+
+    if hasattr(signal, 'SIGHUP'):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, on_sighup)
+    runner = None
+    try:
+        if getattr(config, 'RUN_MODE', 'polling') == 'webhook':
+            app = create_supervisor_app(pool, {WEBHOOK_PATHS[bot["bot"]]: bot["bot"] for bot in bots})
+            runner = web.AppRunner(app)
+            await runner.setup()
+            await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+            if WEBHOOK_BASE_URL:
+                for bot in bots:
+                    await bot.set_webhook(f"{WEBHOOK_BASE_URL}/webhook/{WEBHOOK_PATHS[bot['bot']]}",
+                                          secret_token=WEBHOOK_SECRET)
+        else:
+            for bot in bots:
+                await bot.delete_webhook()
+                tasks.append(asyncio.create_task(_poll(bot, pool)))
+        await asyncio.gather(*tasks)
+    finally:
+        if hasattr(signal, 'SIGHUP'):
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+        if rolling_restart is not None:
+            rolling_restart.cancel()
+        for task in tasks:
+            task.cancel()
+        if runner is not None:
+            await runner.cleanup()
+        await pool.stop()
+        for bot in bots:
+            session = await bot.get_session()
+            await session.close()